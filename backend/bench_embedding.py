@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import numpy as np
+
+from service.embedrpc import EmbeddingClient
+
+QUERIES = [
+    "How do I find my course?",
+    "How do I grade an assignment in SpeedGrader?",
+    "Can I attach a rubric to a discussion?",
+    "Why can't my students see the module I published?",
+    "How do I change the due date for one student?",
+    "Where do I find the course import tool?",
+]
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status", "r") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+async def run(path: str, requests: int, concurrency: int) -> list[float]:
+    client = EmbeddingClient(path)
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for i in remaining:
+            started = time.perf_counter()
+            await client.encode([QUERIES[i % len(QUERIES)]])
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await client.close()
+    return latencies
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measures embedding server throughput and process memory")
+    parser.add_argument("--socket", default=os.getenv("EMBEDDING_SERVER_SOCKET", "/tmp/cpal-embedding.sock"))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--pids", type=int, nargs="*", default=[],
+        help="processes to report resident memory for, like the server and each API worker")
+    args = parser.parse_args()
+
+    print(f"[INFO] {'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for concurrency in args.concurrency:
+        started = time.perf_counter()
+        latencies = asyncio.run(run(args.socket, args.requests, concurrency))
+        elapsed = time.perf_counter() - started
+        print(f"[INFO] {concurrency:>7} {args.requests / elapsed:>8.1f} " +
+            f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f}")
+
+    for pid in args.pids:
+        print(f"[INFO] PID {pid}: {rss_mb(pid):.0f} MB resident")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import sys
+import json
+import time
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+VERIFY_PATH = "/siteverify"
+# Tokens starting with this fail verification, like an expired or reused token
+REJECT_PREFIX = "invalid"
+
+class StubVerifier:
+    """
+    Local stand-in for reCAPTCHA's siteverify endpoint, for development
+    without Google keys and for the tests. Every token passes unless it
+    starts with REJECT_PREFIX, and each answer can be delayed to exercise
+    timeouts. Point CAPTCHA_VERIFY_URL at url to use it.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0):
+        self.delay = delay
+        self.tokens: list[str] = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{VERIFY_PATH}"
+
+    @property
+    def calls(self) -> int:
+        with self.lock:
+            return len(self.tokens)
+
+    def start(self) -> "StubVerifier":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        verifier = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != VERIFY_PATH:
+                    self.send_error(404)
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                token = parse_qs(body).get("response", [""])[0]
+                with verifier.lock:
+                    verifier.tokens.append(token)
+                time.sleep(verifier.delay)
+
+                success = token != "" and not token.startswith(REJECT_PREFIX)
+                result = {"success": success}
+                if not success:
+                    result["error-codes"] = ["invalid-input-response"]
+                payload = json.dumps(result).encode("utf-8")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, as in the timeout tests
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Serves a local reCAPTCHA siteverify stub")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before each answer")
+    args = parser.parse_args()
+
+    verifier = StubVerifier(port=args.port, delay=args.delay)
+    print(f"[INFO] Set CAPTCHA_VERIFY_URL={verifier.url} to verify against this stub")
+    print(f"[INFO] Tokens starting with '{REJECT_PREFIX}' fail, all others pass")
+    try:
+        verifier.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    verifier.server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
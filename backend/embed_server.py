@@ -0,0 +1,47 @@
+import os
+import sys
+import signal
+import asyncio
+import argparse
+
+from service import embedding
+from service.embedrpc import serve
+from util import log
+
+DEFAULT_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET", "/tmp/cpal-embedding.sock")
+
+async def run(path: str):
+    # Load the model before opening the socket so API workers only connect
+    # once it can answer
+    await asyncio.to_thread(embedding.init)
+    embedding.batcher.start()
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = await serve(path, embedding.extract_embeddings_many_async)
+    log.info(f"Embedding server listening on {path}")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+
+    server.close()
+    await server.wait_closed()
+    await embedding.batcher.stop()
+    os.remove(path)
+    log.info("Embedding server stopped", **embedding.batcher.stats())
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Serves the embedding model to API workers over a Unix socket")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path of the Unix socket")
+    args = parser.parse_args()
+    if embedding.SERVER_SOCKET:
+        log.error("EMBEDDING_SERVER is set, so the server would call itself. Unset it for this process")
+        return 1
+    asyncio.run(run(args.socket))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,14 @@
 import os
 import sys
 
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from web.api import router as api_router
+from service import captcha, embedding, events, startup
+from util import log, metrics
 
 CURR_DIR = Path(__file__).resolve().parent
 STATIC_DIR = Path(CURR_DIR,"static").resolve()
@@ -14,13 +17,28 @@ HOST: str | None = os.getenv("HOST")
 if HOST == "" or HOST is None:
     sys.exit(1)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Loads the model and connects clients concurrently. Dependencies that
+    # are unreachable keep retrying and show up on /api/readyz.
+    await startup.start()
+    events.writer.start()
+    metrics.start()
+    yield
+    await startup.stop()
+    # Flush queued QA events before the process exits
+    await events.writer.stop()
+    await captcha.close()
+    await embedding.close()
+    await metrics.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins: list[str] = [
     HOST
 ]
 
-print(f"[INFO] Allowed origins: {origins}")
+log.info(f"Allowed origins: {origins}")
 
 app.add_middleware(
     CORSMiddleware,
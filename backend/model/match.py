@@ -1,12 +1,29 @@
-from pydantic import BaseModel, HttpUrl
+from dataclasses import dataclass
 
-class Metadata(BaseModel):
-    source_url: HttpUrl
+# Plain slotted records: matches are built for every search result on the
+# hot path, so they skip validation. Chunk data is checked by the pipeline.
+
+@dataclass(slots=True)
+class Metadata:
+    source_url: str
     source_url_title: str
     text: str
     type: str
+    answer_id: str | None = None
+
+    @classmethod
+    def from_dict(cls, metadata: dict) -> "Metadata":
+        # Stored metadata may carry extra keys, so only pick known fields
+        return cls(
+            source_url=metadata["source_url"],
+            source_url_title=metadata["source_url_title"],
+            text=metadata["text"],
+            type=metadata["type"],
+            answer_id=metadata.get("answer_id"),
+        )
 
-class Match(BaseModel):
+@dataclass(slots=True)
+class Match:
     id: str
     metadata: Metadata
     score: float
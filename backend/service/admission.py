@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from util import metrics
+
+OVERLOADED_ANSWER = "I am sorry. I am answering a lot of questions right now. Please try again in a moment."
+RATE_LIMITED_ANSWER = "I am sorry. You are asking questions faster than I can answer them. Please wait a moment and try again."
+
+# All limits here are per process. start.sh runs WEB_CONCURRENCY workers
+# and each keeps its own limiters and buckets, so a machine allows up to
+# that many times these values. See "Admission control" in the README.
+
+# Concurrency limits: whole queries, and calls to each rate limited provider
+QUERY_CONCURRENCY = int(os.getenv("ADMISSION_QUERY_CONCURRENCY", "16"))
+LLM_CONCURRENCY = int(os.getenv("ADMISSION_LLM_CONCURRENCY", "8"))
+VECTORDB_CONCURRENCY = int(os.getenv("ADMISSION_VECTORDB_CONCURRENCY", "16"))
+# Callers past the limit wait in a queue of this size for up to the timeout
+QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Per client token bucket: sustained questions per minute and burst size.
+# A client is an IP address, and a classroom usually shares one school IP,
+# so these are sized for a class asking at once rather than one student.
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "120"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "60"))
+MAX_TRACKED_CLIENTS = 10000
+
+wait_seconds = metrics.Histogram("cpal_admission_wait_seconds", "Time spent queued for a slot", ("limiter",))
+rejections = metrics.Counter("cpal_admission_rejected_total", "Requests shed by a limiter", ("limiter", "reason"))
+in_flight = metrics.Gauge("cpal_admission_in_flight", "Slots in use", ("limiter",))
+queued = metrics.Gauge("cpal_admission_queued", "Callers waiting for a slot", ("limiter",))
+rate_limited = metrics.Counter("cpal_rate_limited_total", "Queries refused by the per client rate limit")
+
+class OverloadedError(Exception):
+    """Custom exception to indicate a request was shed under load."""
+
+class Limiter:
+    """
+    Caps concurrent work on one dependency. Callers over the cap wait in a
+    bounded FIFO queue until a slot frees up or the timeout passes. When the
+    queue is full they are rejected right away, so a spike fails fast
+    instead of every request timing out together.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        # Counted before awaiting, so a burst cannot slip past together
+        if self.in_flight + self.waiting >= self.limit + self.max_queue:
+            self.rejected_full += 1
+            rejections.inc(limiter=self.name, reason="full")
+            raise OverloadedError(f"{self.name} queue is full")
+        self.waiting += 1
+        self._report()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            rejections.inc(limiter=self.name, reason="timeout")
+            raise OverloadedError(f"Timed out waiting for {self.name}")
+        finally:
+            self.waiting -= 1
+            wait_seconds.observe(time.perf_counter() - started, limiter=self.name)
+
+        self.admitted += 1
+        self.in_flight += 1
+        self._report()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+            self._report()
+
+    def _report(self):
+        in_flight.set(self.in_flight, limiter=self.name)
+        queued.set(self.waiting, limiter=self.name)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.waiting,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+class RateLimiter:
+    """
+    Token bucket per client. Buckets refill continuously at rate tokens per
+    second up to burst, and the least recently seen clients are forgotten
+    past MAX_TRACKED_CLIENTS.
+    """
+
+    def __init__(self, per_minute: float, burst: float):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > MAX_TRACKED_CLIENTS:
+            self.buckets.popitem(last=False)
+
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+            rate_limited.inc()
+        return allowed
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": self.limited, "clients": len(self.buckets)}
+
+queries = Limiter("query", QUERY_CONCURRENCY, QUEUE_SIZE, QUEUE_TIMEOUT)
+llm = Limiter("llm", LLM_CONCURRENCY, QUEUE_SIZE, QUEUE_TIMEOUT)
+vectordb = Limiter("vectordb", VECTORDB_CONCURRENCY, QUEUE_SIZE, QUEUE_TIMEOUT)
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+
+def client_ip(headers, host: str | None) -> str | None:
+    """
+    The client's address behind Fly's proxy, which sets Fly-Client-IP
+    """
+    forwarded = headers.get("fly-client-ip") or headers.get("x-forwarded-for", "").split(",")[0].strip()
+    return forwarded or host
+
+def stats() -> dict:
+    return {
+        "query": queries.stats(),
+        "llm": llm.stats(),
+        "vectordb": vectordb.stats(),
+        "rate_limit": rate_limiter.stats(),
+    }
@@ -0,0 +1,108 @@
+import asyncio
+
+from concurrent.futures import Executor
+from typing import Any, Callable
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for a short window and runs them through a
+    batch function in one call. Each caller gets back its own row of the
+    batch result.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[list[Any]], Any],
+        executor: Executor,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        max_concurrent_batches: int = 1,
+    ):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_concurrent_batches = max_concurrent_batches
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+        self.slots: asyncio.Semaphore | None = None
+        self.running: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self.worker = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+
+    async def submit(self, item: Any) -> Any:
+        if self.worker is None or self.worker.done():
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Keep collecting while every worker is busy so the next batch
+            # grows instead of queueing up behind the current one
+            await self.slots.acquire()
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if len(batch) == 0:
+                self.slots.release()
+                continue
+            task = asyncio.create_task(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        items = [item for item, _ in batch]
+        try:
+            results = await loop.run_in_executor(self.executor, self.batch_fn, items)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        finally:
+            self.slots.release()
+
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from util import log, metrics
+
+CACHE_BACKEND = os.getenv("SEMANTIC_CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.sqlite")
+CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+
+lookups = metrics.Counter("cpal_semantic_cache_lookups_total", "Semantic cache lookups by result", ("result",))
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    sources: list[dict]
+    chunk_ids: list[str]
+    created_at: float
+
+def normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class MemoryBackend:
+    """
+    In-process store with LRU and TTL eviction. Lookups are a single
+    matrix-vector product over the stored query embeddings.
+    """
+    blocking = False
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[np.ndarray, CachedAnswer]] = OrderedDict()
+        self.next_key = 0
+        self.matrix: np.ndarray | None = None
+        self.keys: list[int] = []
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, vector: np.ndarray, threshold: float, now: float) -> CachedAnswer | None:
+        with self.lock:
+            self._expire(now)
+            if len(self.entries) == 0:
+                return None
+            if self.matrix is None:
+                self.keys = list(self.entries.keys())
+                self.matrix = np.stack([self.entries[k][0] for k in self.keys])
+            scores = self.matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            key = self.keys[best]
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+
+    def put(self, vector: np.ndarray, entry: CachedAnswer):
+        with self.lock:
+            self.entries[self.next_key] = (vector, entry)
+            self.next_key += 1
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def _expire(self, now: float):
+        expired = [k for k, (_, e) in self.entries.items() if now - e.created_at > self.ttl]
+        for k in expired:
+            del self.entries[k]
+        if expired:
+            self.matrix = None
+
+class SqliteBackend:
+    """
+    Store shared by every worker on a machine through a local SQLite file.
+    Each worker mirrors the embeddings in memory and only pulls rows newer
+    than the last one it has seen, so lookups stay in-process.
+    """
+    blocking = True
+
+    def __init__(self, path: str, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "embedding BLOB NOT NULL, "
+            "answer TEXT NOT NULL, "
+            "sources TEXT NOT NULL, "
+            "chunk_ids TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "last_used REAL NOT NULL)")
+        self.conn.commit()
+        self.last_id = 0
+        self.mirror: dict[int, tuple[np.ndarray, float]] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.mirror)
+
+    def lookup(self, vector: np.ndarray, threshold: float, now: float) -> CachedAnswer | None:
+        with self.lock:
+            self._sync(now)
+            if len(self.mirror) == 0:
+                return None
+            ids = list(self.mirror.keys())
+            scores = np.stack([self.mirror[i][0] for i in ids]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            row = self.conn.execute(
+                "SELECT answer, sources, chunk_ids, created_at FROM semantic_cache WHERE id = ?",
+                (ids[best],)).fetchone()
+            if row is None:
+                # Evicted by another worker
+                del self.mirror[ids[best]]
+                return None
+            self.conn.execute("UPDATE semantic_cache SET last_used = ? WHERE id = ?", (now, ids[best]))
+            self.conn.commit()
+            return CachedAnswer(answer=row[0], sources=json.loads(row[1]), chunk_ids=json.loads(row[2]), created_at=row[3])
+
+    def put(self, vector: np.ndarray, entry: CachedAnswer):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO semantic_cache (embedding, answer, sources, chunk_ids, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (vector.astype(np.float32).tobytes(), entry.answer, json.dumps(entry.sources),
+                    json.dumps(entry.chunk_ids), entry.created_at, entry.created_at))
+            self.conn.execute("DELETE FROM semantic_cache WHERE created_at < ?", (entry.created_at - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM semantic_cache WHERE id NOT IN "
+                "(SELECT id FROM semantic_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.capacity,))
+            self.conn.commit()
+
+    def _sync(self, now: float):
+        rows = self.conn.execute(
+            "SELECT id, embedding, created_at FROM semantic_cache WHERE id > ?",
+            (self.last_id,)).fetchall()
+        for id, blob, created_at in rows:
+            self.mirror[id] = (np.frombuffer(blob, dtype=np.float32), created_at)
+            self.last_id = max(self.last_id, id)
+        for id in [i for i, (_, created_at) in self.mirror.items() if now - created_at > self.ttl]:
+            del self.mirror[id]
+        if len(self.mirror) > 2 * self.capacity:
+            # Drop rows other workers have evicted for capacity
+            live = {row[0] for row in self.conn.execute("SELECT id FROM semantic_cache")}
+            self.mirror = {id: v for id, v in self.mirror.items() if id in live}
+
+class SemanticCache:
+    def __init__(self, backend, threshold: float):
+        self.backend = backend
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+
+    @metrics.timed("cache_lookup")
+    def lookup(self, embeddings) -> CachedAnswer | None:
+        entry = self.backend.lookup(normalize(embeddings), self.threshold, time.time())
+        if entry is None:
+            self.misses += 1
+            lookups.inc(result="miss")
+        else:
+            self.hits += 1
+            lookups.inc(result="hit")
+        return entry
+
+    @metrics.timed("cache_store")
+    def store(self, embeddings, answer: str, sources: list[dict], chunk_ids: list[str]):
+        entry = CachedAnswer(answer=answer, sources=sources, chunk_ids=chunk_ids, created_at=time.time())
+        self.backend.put(normalize(embeddings), entry)
+
+    async def lookup_async(self, embeddings) -> CachedAnswer | None:
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.lookup, embeddings)
+        return self.lookup(embeddings)
+
+    async def store_async(self, embeddings, answer: str, sources: list[dict], chunk_ids: list[str]):
+        if self.backend.blocking:
+            return await asyncio.to_thread(self.store, embeddings, answer, sources, chunk_ids)
+        return self.store(embeddings, answer, sources, chunk_ids)
+
+    def stats(self) -> dict:
+        return {
+            "backend": CACHE_BACKEND,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.backend),
+        }
+
+def create_cache() -> SemanticCache | None:
+    if CACHE_BACKEND == "memory":
+        return SemanticCache(MemoryBackend(CACHE_SIZE, CACHE_TTL), CACHE_THRESHOLD)
+    if CACHE_BACKEND == "sqlite":
+        return SemanticCache(SqliteBackend(CACHE_PATH, CACHE_SIZE, CACHE_TTL), CACHE_THRESHOLD)
+    if CACHE_BACKEND not in ("", "off"):
+        log.warn(f"Unknown semantic cache backend '{CACHE_BACKEND}'. Caching is disabled")
+    return None
+
+semantic_cache = create_cache()
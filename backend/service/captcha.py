@@ -1,8 +1,85 @@
 import os
-import requests
+import time
+import asyncio
+import httpx
 
-def verify(token: str, remote_ip: str | None = None) -> bool:
-    url = "https://www.google.com/recaptcha/api/siteverify"
+from collections import OrderedDict
+from dataclasses import dataclass
+from util import log, metrics
+
+VERIFY_URL = os.getenv("CAPTCHA_VERIFY_URL", "https://www.google.com/recaptcha/api/siteverify")
+VERIFY_TIMEOUT = float(os.getenv("CAPTCHA_TIMEOUT", "3"))
+# reCAPTCHA tokens are only valid for two minutes
+TOKEN_CACHE_TTL = float(os.getenv("CAPTCHA_CACHE_TTL", "120"))
+TOKEN_CACHE_SIZE = 10000
+# Queries one verified token may answer: a retry or a double submit, but not
+# a script replaying it for the whole two minutes
+TOKEN_MAX_USES = int(os.getenv("CAPTCHA_TOKEN_MAX_USES", "3"))
+
+client: httpx.AsyncClient | None = None
+
+@dataclass(slots=True)
+class Verification:
+    remote_ip: str | None
+    expires_at: float
+    uses: int = 0
+
+# Tokens that already passed, so retries and double submits are not sent to
+# Google again (which would reject them as duplicates anyway). Each is bound
+# to the client that verified it.
+verified_tokens: OrderedDict[str, Verification] = OrderedDict()
+pending: dict[tuple[str, str | None], asyncio.Task] = {}
+
+stats_counters = {
+    "requests": 0,
+    "cache_hits": 0,
+    "reuse_rejected": 0,
+    "failures": 0,
+    "latency_ms_total": 0.0,
+    "latency_ms_max": 0.0,
+}
+
+def get_client() -> httpx.AsyncClient:
+    global client
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(VERIFY_TIMEOUT),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        )
+    return client
+
+async def close():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+def cached(token: str, now: float) -> Verification | None:
+    verification = verified_tokens.get(token)
+    if verification is not None and verification.expires_at < now:
+        del verified_tokens[token]
+        return None
+    return verification
+
+def take_use(verification: Verification, remote_ip: str | None) -> bool:
+    """
+    False when the token was verified for another client or has no uses left
+    """
+    if verification.remote_ip != remote_ip or verification.uses >= TOKEN_MAX_USES:
+        stats_counters["reuse_rejected"] += 1
+        return False
+    verification.uses += 1
+    return True
+
+def remember(token: str, remote_ip: str | None, now: float) -> Verification:
+    verification = verified_tokens[token] = Verification(remote_ip, now + TOKEN_CACHE_TTL)
+    verified_tokens.move_to_end(token)
+    while len(verified_tokens) > TOKEN_CACHE_SIZE:
+        verified_tokens.popitem(last=False)
+    return verification
+
+@metrics.timed("captcha")
+async def request_verification(token: str, remote_ip: str | None) -> bool:
     payload = {
         'secret': os.getenv("CAPTCHA_SITE_SECRET"),
         'response': token,
@@ -11,11 +88,52 @@ def verify(token: str, remote_ip: str | None = None) -> bool:
     if remote_ip is not None:
         payload['remoteip'] = remote_ip
 
+    started = time.perf_counter()
+    stats_counters["requests"] += 1
     try:
-        response = requests.post(url, data=payload)
+        response = await get_client().post(VERIFY_URL, data=payload)
         result = response.json()
-        return result.get("success")    
+        return bool(result.get("success"))
+    except (httpx.HTTPError, ValueError) as e:
+        stats_counters["failures"] += 1
+        log.error(f"reCAPTCHA verification failed: {e}")
+        return False
+    finally:
+        latency = (time.perf_counter() - started) * 1000
+        stats_counters["latency_ms_total"] += latency
+        stats_counters["latency_ms_max"] = max(stats_counters["latency_ms_max"], latency)
 
-    except requests.RequestException as e:
-        print(f"reCAPTCHA verification failed: {e}")
+async def verify_async(token: str, remote_ip: str | None = None) -> bool:
+    verification = cached(token, time.monotonic())
+    if verification is not None:
+        if not take_use(verification, remote_ip):
+            return False
+        stats_counters["cache_hits"] += 1
+        return True
+
+    # Share one siteverify call between concurrent submits of the same token
+    # from the same client
+    key = (token, remote_ip)
+    task = pending.get(key)
+    if task is None:
+        task = asyncio.create_task(request_verification(token, remote_ip))
+        pending[key] = task
+        task.add_done_callback(lambda _: pending.pop(key, None))
+    else:
+        stats_counters["cache_hits"] += 1
+
+    if not await asyncio.shield(task):
         return False
+    # Submits that shared the call each take a use of the one verification
+    verification = verified_tokens.get(token)
+    if verification is None:
+        verification = remember(token, remote_ip, time.monotonic())
+    return take_use(verification, remote_ip)
+
+def stats() -> dict:
+    requests = stats_counters["requests"]
+    return {
+        **stats_counters,
+        "latency_ms_avg": stats_counters["latency_ms_total"] / requests if requests else 0.0,
+        "cached_tokens": len(verified_tokens),
+    }
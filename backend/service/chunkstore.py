@@ -0,0 +1,48 @@
+import os
+import sqlite3
+import threading
+
+from model.match import Metadata
+from util import log
+
+# Kept up to date by pipeline/python/run_pipeline.py, which applies the
+# chunks it encodes so the text changes together with the vectors, or
+# rebuilt by build_chunk_store.py. When the file exists the vector database
+# is only asked for ids and scores.
+CHUNK_STORE_PATH: str = os.getenv("CHUNK_STORE_PATH", os.path.join(".", "chunks.sqlite"))
+
+class ChunkStore:
+    """
+    Read-only chunk metadata keyed by chunk id. Each thread opens its own
+    connection since lookups run both on the event loop and in worker
+    threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.count = self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get_many(self, ids: list[str]) -> dict[str, Metadata]:
+        if len(ids) == 0:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        rows = self._connection().execute(
+            "SELECT id, source_url, source_url_title, text, type, answer_id "
+            f"FROM chunks WHERE id IN ({placeholders})", ids)
+        return {row[0]: Metadata(*row[1:]) for row in rows}
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self.local.conn = conn
+        return conn
+
+chunk_store = None
+if os.path.exists(CHUNK_STORE_PATH):
+    chunk_store = ChunkStore(CHUNK_STORE_PATH)
+    log.info(f"Loaded chunk store with {len(chunk_store)} chunks from {CHUNK_STORE_PATH}")
@@ -1,7 +1,79 @@
-from sentence_transformers import SentenceTransformer
-from torch import Tensor
+import os
+import asyncio
 
-model = SentenceTransformer("sentence-transformers/multi-qa-MiniLM-L6-cos-v1")
+from concurrent.futures import ThreadPoolExecutor
+from numpy import ndarray
+from service.batcher import MicroBatcher
+from service.embedrpc import EmbeddingClient
+from service.encoder import load_encoder
+from util import log, metrics
 
-def extract_embeddings(text: str) -> Tensor:
-    return model.encode(text)
+# Encoding is CPU-bound, so it gets its own small pool rather than competing
+# with network calls in the event loop's default executor
+ENCODE_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1"))
+MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32"))
+MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))
+
+# "torch" runs the sentence-transformers model, "onnx" the exported model
+# from pipeline/python/export_onnx.py (int8 unless EMBEDDING_ONNX_QUANTIZED
+# is false), which needs neither torch nor sentence-transformers
+BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", os.path.join(".", "onnx"))
+ONNX_QUANTIZED = os.getenv("EMBEDDING_ONNX_QUANTIZED", "true").lower() == "true"
+
+# With several API workers, each one sends its texts to a single shared
+# embedding server (embed_server.py) instead of loading its own model
+SERVER_SOCKET = os.getenv("EMBEDDING_SERVER")
+
+model = None
+remote = EmbeddingClient(SERVER_SOCKET) if SERVER_SOCKET else None
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+def init():
+    """
+    Loads the model and runs one encode, so the first query does not pay
+    for lazy allocations in the runtime
+    """
+    global model
+    if remote is not None:
+        remote.encode_blocking(["How do I find my course?"])
+        log.info(f"Using the embedding server at {SERVER_SOCKET}")
+        return
+    encoder = load_encoder(BACKEND, ONNX_DIR, quantized=ONNX_QUANTIZED)
+    encoder.encode(["How do I find my course?"])
+    model = encoder
+    log.info(f"Loaded {model.name} embedding model")
+
+def extract_embeddings_batch(texts: list[str]) -> ndarray:
+    return model.encode(texts, batch_size=len(texts))
+
+# Concurrent requests are grouped into a single batched forward pass
+batcher = MicroBatcher(
+    extract_embeddings_batch,
+    encode_pool,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_WAIT_MS,
+    max_concurrent_batches=ENCODE_WORKERS,
+)
+
+@metrics.timed("embedding")
+async def extract_embeddings_async(text: str) -> ndarray:
+    if remote is not None:
+        return (await remote.encode([text]))[0]
+    return await batcher.submit(text)
+
+@metrics.timed("embedding")
+async def extract_embeddings_many_async(texts: list[str]) -> list[ndarray]:
+    if remote is not None:
+        return list(await remote.encode(texts))
+    # Submitted together, so the batcher encodes them in one forward pass
+    return await asyncio.gather(*(batcher.submit(text) for text in texts))
+
+async def close():
+    if remote is not None:
+        await remote.close()
+
+def stats() -> dict:
+    if remote is not None:
+        return {"server": remote.stats()}
+    return {"batcher": batcher.stats()}
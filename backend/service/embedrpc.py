@@ -0,0 +1,118 @@
+import json
+import socket
+import asyncio
+import numpy as np
+
+from typing import Awaitable, Callable
+
+# Requests are a 4 byte big-endian length and a JSON list of texts.
+# Responses are a status byte, a 4 byte length, then either the float32
+# embeddings row by row (status 0) or a UTF-8 error message (status 1).
+STATUS_OK = 0
+STATUS_ERROR = 1
+MAX_IDLE_CONNECTIONS = 16
+
+def encode_request(texts: list[str]) -> bytes:
+    payload = json.dumps(texts).encode("utf-8")
+    return len(payload).to_bytes(4, "big") + payload
+
+def encode_response(status: int, payload: bytes) -> bytes:
+    return bytes([status]) + len(payload).to_bytes(4, "big") + payload
+
+def decode_response(status: int, payload: bytes, rows: int) -> np.ndarray:
+    if status != STATUS_OK:
+        raise RuntimeError(f"Embedding server error: {payload.decode('utf-8')}")
+    return np.frombuffer(payload, dtype=np.float32).reshape(rows, -1)
+
+class EmbeddingClient:
+    """
+    Calls the embedding server (embed_server.py) over a Unix socket. Each
+    request holds a connection to itself, and idle connections are kept for
+    reuse.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self.requests = 0
+        self.errors = 0
+
+    async def encode(self, texts: list[str]) -> np.ndarray:
+        reader, writer = self.idle.pop() if self.idle else await asyncio.open_unix_connection(self.path)
+        self.requests += 1
+        try:
+            writer.write(encode_request(texts))
+            await writer.drain()
+            header = await reader.readexactly(5)
+            payload = await reader.readexactly(int.from_bytes(header[1:], "big"))
+        except BaseException:
+            # A half read response would corrupt the next request
+            self.errors += 1
+            writer.close()
+            raise
+        if len(self.idle) < MAX_IDLE_CONNECTIONS:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        return decode_response(header[0], payload, len(texts))
+
+    def encode_blocking(self, texts: list[str], timeout: float = 10.0) -> np.ndarray:
+        """
+        One-off request from a thread, for startup checks
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(self.path)
+            conn.sendall(encode_request(texts))
+            header = self._recv_exactly(conn, 5)
+            payload = self._recv_exactly(conn, int.from_bytes(header[1:], "big"))
+        return decode_response(header[0], payload, len(texts))
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+    def stats(self) -> dict:
+        return {"socket": self.path, "requests": self.requests, "errors": self.errors, "idle_connections": len(self.idle)}
+
+    @staticmethod
+    def _recv_exactly(conn: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Embedding server closed the connection")
+            data += chunk
+        return bytes(data)
+
+async def serve(path: str, encode: Callable[[list[str]], Awaitable[list[np.ndarray]]]) -> asyncio.AbstractServer:
+    """
+    Starts a Unix socket server that answers requests with encode. Requests
+    from every connection go through encode concurrently, so its batcher
+    can group them.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    break
+                texts = json.loads(await reader.readexactly(int.from_bytes(header, "big")))
+                try:
+                    vectors = await encode(texts)
+                    response = encode_response(STATUS_OK, np.asarray(vectors, dtype=np.float32).tobytes())
+                except Exception as err:
+                    response = encode_response(STATUS_ERROR, str(err).encode("utf-8"))
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Open connections are cancelled when the server shuts down
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_unix_server(handle, path=path)
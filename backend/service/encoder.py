@@ -0,0 +1,81 @@
+import os
+import numpy as np
+
+# Shared by the backend and pipeline/python/generate_embeddings.py so both
+# produce the same vectors. Keep it free of other service imports.
+
+MODEL_NAME = "sentence-transformers/multi-qa-MiniLM-L6-cos-v1"
+DIMENSIONS = 384
+MAX_SEQ_LENGTH = 512
+TOKENIZER_FILE = "tokenizer.json"
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+
+class TorchEncoder:
+    """
+    The PyTorch model through sentence-transformers
+    """
+    name = "torch"
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(MODEL_NAME)
+
+    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size)
+
+class OnnxEncoder:
+    """
+    The same model exported to ONNX by pipeline/python/export_onnx.py, run
+    with onnxruntime and the model's fast tokenizer. Applies the mean pooling
+    and normalization that sentence-transformers adds on top of the
+    transformer.
+    """
+    name = "onnx"
+
+    def __init__(self, model_dir: str, quantized: bool = True, threads: int = 0):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        model_path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {input.name for input in self.session.get_inputs()}
+        if quantized:
+            self.name = "onnx-int8"
+
+    def encode(self, texts: list[str], batch_size: int = 32) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, DIMENSIONS), dtype=np.float32)
+        batches = [self._encode_batch(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+        return np.concatenate(batches)
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+
+        hidden = self.session.run(None, inputs)[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+def load_encoder(backend: str = "torch", model_dir: str = "onnx", quantized: bool = True, threads: int = 0):
+    """
+    Loads the encoder for backend ("torch" or "onnx")
+    """
+    if backend == "onnx":
+        return OnnxEncoder(model_dir, quantized=quantized, threads=threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend '{backend}'")
+    return TorchEncoder()
@@ -1,13 +1,33 @@
-from sqlmodel import Session, create_engine
+from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import text
 from model.event import QAEvent
+from util import log, metrics
 from typing import Optional
 import os
+import time
+import asyncio
 
 DATABASE_URL: str | None = os.getenv("DATABASE_URL")
 if DATABASE_URL is None:
     raise ValueError("DATABASE_URL environment variable is not set")
 
-engine = create_engine(DATABASE_URL, echo=True, pool_pre_ping=True)
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "false").lower() == "true"
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "50"))
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "2"))
+
+engine = create_engine(DATABASE_URL, echo=DATABASE_ECHO, pool_pre_ping=True)
+
+def init():
+    """
+    Checks that the database is reachable
+    """
+    # Local SQLite databases are used for development and tests, so create
+    # the table there. The production table is managed outside the app.
+    if engine.dialect.name == "sqlite":
+        SQLModel.metadata.create_all(engine)
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
 
 def log_qa(
     question: Optional[str] = None,
@@ -21,3 +41,144 @@ def log_qa(
         session.refresh(event)
     return event
 
+def write_events(events: list[QAEvent]):
+    with Session(engine) as session:
+        session.add_all(events)
+        session.commit()
+
+# Queued by stop() behind the pending events. The worker finishes its batch
+# and returns when it takes this off the queue, so shutdown never depends on
+# cancelling a task that is waiting on the queue
+STOP = object()
+
+class EventWriter:
+    """
+    Buffers QA events in a bounded queue and writes them in bulk from a
+    background task, either when a batch fills up or when the flush interval
+    passes. Events are dropped (and counted) when the queue is full.
+    """
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+        # Events taken off the queue but not yet written, in case the worker
+        # died before it could write them
+        self.collecting: list[QAEvent] = []
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        if self.worker is not None and not self.worker.done():
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stops the worker once it has written everything queued before the
+        call, then flushes anything it left behind
+        """
+        if self.worker is not None:
+            if not self.worker.done():
+                # Waits for room if the queue is full, which the running
+                # worker makes
+                await self.queue.put(STOP)
+            try:
+                await self.worker
+            except Exception as err:
+                log.error(f"QA event writer failed: {err}")
+            self.worker = None
+        if self.queue is None:
+            return
+        batch, self.collecting = self.collecting, []
+        while not self.queue.empty():
+            event = self.queue.get_nowait()
+            if event is STOP:
+                continue
+            batch.append(event)
+            if len(batch) >= self.batch_size:
+                await self._flush(batch)
+                batch = []
+        await self._flush(batch)
+
+    def enqueue(self, event: QAEvent) -> bool:
+        self.start()
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warn("Event queue is full. Dropped QA event", uuid=event.uuid)
+            return False
+        self.enqueued += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await self.queue.get()
+            if event is STOP:
+                return
+            self.collecting.append(event)
+            deadline = loop.time() + self.flush_interval
+            while len(self.collecting) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is STOP:
+                    stopping = True
+                    break
+                self.collecting.append(event)
+            batch, self.collecting = self.collecting, []
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[QAEvent]):
+        if len(batch) == 0:
+            return
+        started = time.perf_counter()
+        try:
+            with metrics.span("events_write"):
+                await asyncio.to_thread(write_events, batch)
+        except Exception as err:
+            self.failed += len(batch)
+            log.error(f"Failed to write {len(batch)} QA events: {err}")
+            return
+        self.written += len(batch)
+        self.batches += 1
+        log.info(f"Wrote {len(batch)} QA events", ms=round((time.perf_counter() - started) * 1000, 1))
+
+writer = EventWriter(EVENT_QUEUE_SIZE, EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL)
+
+async def log_qa_async(
+    question: Optional[str] = None,
+    chunk_ids: Optional[str] = None,
+    answer: Optional[str] = None,
+):
+    """
+    Queues the event for the background writer instead of writing it on the
+    response path
+    """
+    event = QAEvent(question=question, chunk_ids=chunk_ids, answer=answer)
+    writer.enqueue(event)
+    return event
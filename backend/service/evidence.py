@@ -0,0 +1,89 @@
+import os
+import re
+
+from dataclasses import dataclass, field
+from model.match import Match
+from util import metrics
+
+# Rough budget for the evidence part of the answer prompt, in tokens
+EVIDENCE_TOKEN_BUDGET = int(os.getenv("EVIDENCE_TOKEN_BUDGET", "1500"))
+# Chunks whose word shingles overlap at least this much count as duplicates
+EVIDENCE_DEDUP_THRESHOLD = float(os.getenv("EVIDENCE_DEDUP_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 3
+# Gemini averages about four characters per token for English text
+CHARS_PER_TOKEN = 4
+
+WORD_REGEX = re.compile(r"\w+")
+
+@dataclass
+class Evidence:
+    matches: list[Match] = field(default_factory=list)
+    texts: list[str] = field(default_factory=list)
+    tokens: int = 0
+    duplicates: int = 0
+    trimmed: int = 0
+
+    def text(self) -> str:
+        return "\n".join(f"[{i + 1}] {text}" for i, text in enumerate(self.texts))
+
+stats_counters = {"requests": 0, "tokens": 0, "max_tokens": 0, "duplicates": 0, "trimmed": 0}
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def shingles(text: str) -> set[tuple[str, ...]]:
+    words = WORD_REGEX.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def jaccard(a: set, b: set) -> float:
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+@metrics.timed("evidence")
+def build_evidence(matches: list[Match], budget: int = EVIDENCE_TOKEN_BUDGET) -> Evidence:
+    """
+    Picks the chunks for the answer prompt. Near-duplicates of a better
+    scoring chunk are dropped, then chunks are kept in score order until the
+    token budget runs out, so the lowest scores are trimmed first. The best
+    chunk is always kept, cut down to the budget if needed.
+    """
+    evidence = Evidence()
+    kept_shingles = []
+    full = False
+    for match in sorted(matches, key=lambda match: match.score, reverse=True):
+        match_shingles = shingles(match.metadata.text)
+        if any(jaccard(match_shingles, kept) >= EVIDENCE_DEDUP_THRESHOLD for kept in kept_shingles):
+            evidence.duplicates += 1
+            continue
+
+        text = match.metadata.text
+        tokens = estimate_tokens(text)
+        if full or evidence.tokens + tokens > budget:
+            if len(evidence.matches) > 0:
+                full = True
+                evidence.trimmed += 1
+                continue
+            text = text[:budget * CHARS_PER_TOKEN]
+            tokens = budget
+        evidence.matches.append(match)
+        evidence.texts.append(text)
+        evidence.tokens += tokens
+        kept_shingles.append(match_shingles)
+
+    stats_counters["requests"] += 1
+    stats_counters["tokens"] += evidence.tokens
+    stats_counters["max_tokens"] = max(stats_counters["max_tokens"], evidence.tokens)
+    stats_counters["duplicates"] += evidence.duplicates
+    stats_counters["trimmed"] += evidence.trimmed
+    return evidence
+
+def stats() -> dict:
+    requests = stats_counters["requests"]
+    return {
+        **stats_counters,
+        "budget": EVIDENCE_TOKEN_BUDGET,
+        "average_tokens": stats_counters["tokens"] / requests if requests else 0.0,
+    }
@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import numpy as np
+
+from model.match import Match, Metadata
+from util import log, metrics
+
+# Built by pipeline/python/build_lexical_index.py and rebuilt by
+# run_pipeline.py whenever the chunk store changes. Keyword search is off
+# when the directory does not exist.
+LEXICAL_INDEX_DIR: str = os.getenv("LEXICAL_INDEX_DIR", os.path.join(".", "lexical"))
+# Weight of the BM25 ranking in the fused ranking (the rest is the vector
+# ranking). At 0.5 the best keyword hit can displace the last vector hit.
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "0.5"))
+LEXICAL_TOP_K = int(os.getenv("LEXICAL_TOP_K", "5"))
+# Chunks only found by keyword must be at least this similar to the query,
+# the same bar qa applies to evidence, to take a place in the results.
+# Chunks indexed without a vector are ranked by BM25 alone and get this as
+# their score.
+LEXICAL_MIN_SIMILARITY = float(os.getenv("LEXICAL_MIN_SIMILARITY", "0.50"))
+RRF_K = 60
+
+# Must match pipeline/python/build_lexical_index.py
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "does",
+    "for", "from", "has", "have", "how", "i", "if", "in", "is", "it", "its", "me",
+    "my", "of", "on", "or", "so", "that", "the", "their", "then", "there", "these",
+    "this", "to", "was", "what", "when", "where", "which", "who", "why", "will",
+    "with", "you", "your",
+])
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_REGEX.findall(text.lower()) if token not in STOP_WORDS]
+
+class LexicalIndex:
+    """
+    Read-only BM25 inverted index. Postings are stored term by term in flat
+    row and term frequency arrays, so scoring a query only touches the
+    postings of its terms.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.rows = np.load(os.path.join(path, "rows.npy"), mmap_mode="r")
+        self.tfs = np.load(os.path.join(path, "tfs.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(path, "lengths.npy")).astype(np.float32)
+        with open(os.path.join(path, "terms.json"), "r") as terms_file:
+            self.terms = {term: i for i, term in enumerate(json.load(terms_file))}
+        with open(os.path.join(path, "params.json"), "r") as params_file:
+            params = json.load(params_file)
+        self.k1 = params["k1"]
+        self.b = params["b"]
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        with open(os.path.join(path, "chunks.jsonl"), "r") as chunks_file:
+            for line in chunks_file:
+                chunk = json.loads(line)
+                self.ids.append(chunk.pop("id"))
+                self.metadata.append(chunk)
+        self.rows_by_id = {id: row for row, id in enumerate(self.ids)}
+        assert len(self.ids) == len(self.lengths), "Chunk table does not match index"
+        # Unit length float16 embeddings row for row, all zeros where a chunk
+        # has none. Missing when the index was built from chunk files.
+        self.vectors = None
+        vectors_path = os.path.join(path, "vectors.npy")
+        if os.path.exists(vectors_path):
+            self.vectors = np.load(vectors_path, mmap_mode="r")
+            assert len(self.vectors) == len(self.ids), "Vectors do not match index"
+        # Length normalization only depends on the chunk, so precompute it
+        self.norms = self.k1 * (1 - self.b + self.b * self.lengths / params["avgdl"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, text: str, top_k: int = 5) -> list[tuple[int, float]]:
+        """
+        Returns (row, BM25 score) pairs for the top_k best matching chunks
+        """
+        scores = self.score(text)
+        if scores is None:
+            return []
+        return self.top(scores, top_k)
+
+    def score(self, text: str) -> np.ndarray | None:
+        """
+        BM25 score of every chunk for the text, or None when no query term
+        is in the index
+        """
+        n = len(self.ids)
+        scores = None
+        for term in set(tokenize(text)):
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            rows = self.rows[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            df = end - start
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            if scores is None:
+                scores = np.zeros(n, dtype=np.float32)
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + self.norms[rows])
+        return scores
+
+    def top(self, scores: np.ndarray, top_k: int) -> list[tuple[int, float]]:
+        candidates = np.flatnonzero(scores)
+        if len(candidates) == 0:
+            return []
+        k = min(top_k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    def similarities(self, rows: list[int], embeddings: np.ndarray) -> list[float | None]:
+        """
+        Cosine similarity between the query and each row's stored vector, or
+        None for rows without one
+        """
+        if self.vectors is None:
+            return [None] * len(rows)
+        query = np.asarray(embeddings, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        present = np.any(vectors != 0, axis=1)
+        scores = vectors @ query
+        return [float(score) if has else None for score, has in zip(scores, present)]
+
+    def match(self, row: int, score: float) -> Match:
+        return Match(id=self.ids[row], metadata=Metadata.from_dict(self.metadata[row]), score=score)
+
+lexical_index = None
+if os.path.exists(LEXICAL_INDEX_DIR):
+    lexical_index = LexicalIndex(LEXICAL_INDEX_DIR)
+    log.info(f"Loaded lexical index with {len(lexical_index)} chunks from {LEXICAL_INDEX_DIR}")
+
+stats_counters = {"queries": 0, "keyword_only": 0, "unscored": 0}
+
+@metrics.timed("lexical")
+def blend(query: str, matches: list[Match], top_k: int, embeddings: np.ndarray) -> list[Match]:
+    """
+    Reranks vector matches together with BM25 hits for the query using
+    weighted reciprocal rank fusion. The BM25 ranking covers the best
+    keyword hits and every vector match containing a query term, so vector
+    matches with the terms rank higher than those without.
+
+    Chunks only found by keyword are scored against the query embedding
+    with the vectors saved alongside the index, so Match.score stays a
+    similarity score and the relevance thresholds downstream keep their
+    meaning. Ones below LEXICAL_MIN_SIMILARITY are dropped rather than
+    displacing vector matches. Nothing here leaves the process.
+    """
+    if lexical_index is None:
+        return matches
+    scores = lexical_index.score(query)
+    stats_counters["queries"] += 1
+    if scores is None:
+        return matches
+
+    hits = lexical_index.top(scores, LEXICAL_TOP_K)
+    keyword = {lexical_index.ids[row]: score for row, score in hits}
+    for match in matches:
+        row = lexical_index.rows_by_id.get(match.id)
+        if row is not None and scores[row] > 0:
+            keyword[match.id] = float(scores[row])
+
+    candidates = {match.id: match for match in matches}
+    missing = [row for row, _ in hits if lexical_index.ids[row] not in candidates]
+    for row, similarity in zip(missing, lexical_index.similarities(missing, embeddings)):
+        if similarity is None:
+            stats_counters["unscored"] += 1
+            candidates[lexical_index.ids[row]] = lexical_index.match(row, LEXICAL_MIN_SIMILARITY)
+        elif similarity >= LEXICAL_MIN_SIMILARITY:
+            candidates[lexical_index.ids[row]] = lexical_index.match(row, similarity)
+
+    vector_ranks = {match.id: rank for rank, match in enumerate(matches)}
+    keyword_ranks = {id: rank for rank, id in enumerate(sorted(keyword, key=keyword.get, reverse=True))}
+
+    def fused(match: Match) -> float:
+        score = 0.0
+        if match.id in vector_ranks:
+            score += (1 - LEXICAL_WEIGHT) / (RRF_K + vector_ranks[match.id] + 1)
+        if match.id in keyword_ranks:
+            score += LEXICAL_WEIGHT / (RRF_K + keyword_ranks[match.id] + 1)
+        return score
+
+    ranked = sorted(candidates.values(), key=fused, reverse=True)[:top_k]
+    stats_counters["keyword_only"] += sum(1 for match in ranked if match.id not in vector_ranks)
+    return ranked
+
+def stats() -> dict | None:
+    if lexical_index is None:
+        return None
+    return {"chunks": len(lexical_index), "vectors": lexical_index.vectors is not None, **stats_counters}
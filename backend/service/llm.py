@@ -1,15 +1,83 @@
 import os
+import time
 
-from google import genai
+from typing import AsyncIterator
+from service import admission
+from util import log, metrics
 
 LLM_API_KEY = os.getenv("LLM_API_KEY")
+LLM_MODEL = "gemini-2.0-flash"
 
-client = genai.Client(api_key=LLM_API_KEY)
+client = None
+
+def init():
+    # google.genai is slow to import, so it is loaded with the other
+    # services at startup
+    global client
+    from google import genai
+    client = genai.Client(api_key=LLM_API_KEY)
+
+usage_counters = {"requests": 0, "prompt_tokens": 0, "output_tokens": 0, "max_prompt_tokens": 0}
+
+tokens_used = metrics.Counter("cpal_llm_tokens_total", "Tokens Gemini reported using", ("kind",))
+prompt_sizes = metrics.Histogram("cpal_llm_prompt_tokens", "Prompt tokens Gemini reported for each call",
+    buckets=metrics.TOKEN_BUCKETS)
+first_token_seconds = metrics.Histogram("cpal_llm_first_token_seconds", "Time until a streamed answer sends its first text")
+
+def record_usage(usage):
+    """
+    Tracks the token counts Gemini reports for each call
+    """
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_token_count or 0
+    output_tokens = usage.candidates_token_count or 0
+    usage_counters["requests"] += 1
+    usage_counters["prompt_tokens"] += prompt_tokens
+    usage_counters["output_tokens"] += output_tokens
+    usage_counters["max_prompt_tokens"] = max(usage_counters["max_prompt_tokens"], prompt_tokens)
+    tokens_used.inc(prompt_tokens, kind="prompt")
+    tokens_used.inc(output_tokens, kind="output")
+    prompt_sizes.observe(prompt_tokens)
+    log.info("LLM call finished", prompt_tokens=prompt_tokens, output_tokens=output_tokens)
+
+def stats() -> dict:
+    return dict(usage_counters)
 
 def query_llm(prompt: str) -> str:
     response = client.models.generate_content(
-        model="gemini-2.0-flash",
+        model=LLM_MODEL,
         contents=[prompt]
     )
+    record_usage(response.usage_metadata)
+    return response.text
+
+async def query_llm_async(prompt: str, stage: str = "llm_answer") -> str:
+    async with admission.llm.slot():
+        with metrics.span(stage):
+            response = await client.aio.models.generate_content(
+                model=LLM_MODEL,
+                contents=[prompt]
+            )
+    record_usage(response.usage_metadata)
     return response.text
 
+async def stream_llm_async(prompt: str, stage: str = "llm_answer") -> AsyncIterator[str]:
+    # The slot is held until the stream ends, since Gemini is still working
+    async with admission.llm.slot():
+        with metrics.span(stage):
+            started = time.perf_counter()
+            stream = await client.aio.models.generate_content_stream(
+                model=LLM_MODEL,
+                contents=[prompt]
+            )
+            usage = None
+            async for chunk in stream:
+                # The running total arrives with the chunks, so keep the last one
+                usage = chunk.usage_metadata or usage
+                if chunk.text:
+                    if started is not None:
+                        first_token_seconds.observe(time.perf_counter() - started)
+                        started = None
+                    yield chunk.text
+    record_usage(usage)
@@ -0,0 +1,88 @@
+import os
+import json
+import numpy as np
+
+VECTORS_FILE = "vectors.npy"
+CHUNKS_FILE = "chunks.jsonl"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_ORDER_FILE = "ivf_order.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+
+class LocalIndex:
+    """
+    Read-only vector index built by pipeline/python/build_local_index.py.
+    Vectors are unit length rows of a memory-mapped float32 matrix (float16
+    files are loaded into memory as float32), so cosine similarity is a dot
+    product. When the index was built with
+    IVF lists, only the nprobe closest lists are scanned.
+    """
+
+    def __init__(self, path: str, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        if self.vectors.dtype != np.float32:
+            # NumPy has no BLAS path for float16 matrix products, which makes
+            # a scan over ten times slower, so float16 files are only
+            # smaller on disk and are scored as float32 in memory
+            self.vectors = self.vectors.astype(np.float32)
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        with open(os.path.join(path, CHUNKS_FILE), "r") as chunks_file:
+            for line in chunks_file:
+                chunk = json.loads(line)
+                self.ids.append(chunk.pop("id"))
+                self.metadata.append(chunk)
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        assert len(self.ids) == self.vectors.shape[0], "Chunk table does not match vector matrix"
+
+        self.centroids = None
+        centroids_path = os.path.join(path, IVF_CENTROIDS_FILE)
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.order = np.load(os.path.join(path, IVF_ORDER_FILE))
+            self.offsets = np.load(os.path.join(path, IVF_OFFSETS_FILE))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def query(self, vector, top_k: int = 5) -> list[tuple[int, float]]:
+        """
+        Returns (row, score) pairs for the top_k most similar vectors
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        candidates = self._candidates(vector)
+        if candidates is None:
+            scores = self.vectors @ vector
+        else:
+            scores = self.vectors[candidates] @ vector
+
+        k = min(top_k, scores.shape[0])
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = top if candidates is None else candidates[top]
+        return [(int(row), float(scores[i])) for row, i in zip(rows, top)]
+
+    def row(self, id: str) -> int | None:
+        return self.rows.get(id)
+
+    def scan_size(self) -> int:
+        """
+        Rough number of rows one query scores
+        """
+        if self.centroids is None or self.nprobe >= self.centroids.shape[0]:
+            return len(self.ids)
+        return len(self.ids) * self.nprobe // self.centroids.shape[0]
+
+    def _candidates(self, vector: np.ndarray) -> np.ndarray | None:
+        if self.centroids is None or self.nprobe >= self.centroids.shape[0]:
+            return None
+        nearest = np.argpartition(-(self.centroids @ vector), self.nprobe - 1)[:self.nprobe]
+        lists = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in nearest]
+        return np.sort(np.concatenate(lists))
@@ -0,0 +1,432 @@
+import os
+import re
+import asyncio
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+from numpy import ndarray
+from model.match import Match
+from service import admission, captcha, embedding, vectordb, events, llm, lexical, evidence, startup
+from service.cache import semantic_cache
+from service.singleflight import SingleFlight
+from util import log, metrics, sanitize
+
+REJECTED_ANSWER = "I am sorry. I am only designed to answer questions related to Canvas and its commonly integrated applications."
+CAPTCHA_FAILED_ANSWER = "I am sorry. An error occured..."
+NOT_FOUND_ANSWER = "I am sorry. I was unable to find any information related to your query. Maybe try asking it in a different way?"
+ERROR_ANSWER = "I am sorry. An error occured. Please try again."
+
+# "rewrite" always asks the LLM for alternative phrasings before searching.
+# "adaptive" searches with the raw query first and only rewrites when the
+# results are not confident: the top score is below REWRITE_MIN_SCORE, or
+# it is below REWRITE_SURE_SCORE and leads the runner-up by less than
+# REWRITE_MIN_MARGIN, so the query could mean either.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "adaptive")
+REWRITE_MIN_SCORE = float(os.getenv("REWRITE_MIN_SCORE", "0.70"))
+REWRITE_SURE_SCORE = float(os.getenv("REWRITE_SURE_SCORE", "0.85"))
+REWRITE_MIN_MARGIN = float(os.getenv("REWRITE_MIN_MARGIN", "0.02"))
+
+# "rrf" searches the query and each rewrite separately and fuses the ranked
+# results. "concat" embeds the query and rewrites as one string.
+QUERY_FUSION = os.getenv("QUERY_FUSION", "rrf")
+RRF_K = 60
+MAX_REWRITES = 3
+
+# How many queries took each retrieval path, for tuning the thresholds
+path_counts = {"raw": 0, "rewrite": 0, "rewrite_failed": 0}
+
+# Identical questions asked at the same time share one execution
+flights = SingleFlight()
+
+paths = metrics.Counter("cpal_retrieval_paths_total", "Queries by retrieval path", ("path",))
+match_scores = metrics.Histogram("cpal_match_score", "Similarity scores of retrieved chunks",
+    buckets=metrics.SCORE_BUCKETS)
+prompt_sizes = metrics.Histogram("cpal_answer_prompt_tokens", "Estimated tokens in each answer prompt",
+    buckets=metrics.TOKEN_BUCKETS)
+
+@dataclass
+class Retrieval:
+    """
+    Outcome of everything that happens before the answer LLM call. When
+    answer is already set no generation is needed and prompt is None.
+    """
+    query: str
+    answer: str | None = None
+    prompt: str | None = None
+    sources: list[dict] = field(default_factory=list)
+    chunk_ids: list[str] = field(default_factory=list)
+    cache_key: ndarray | None = None
+    cached: bool = False
+    path: str | None = None
+    prompt_tokens: int = 0
+
+def build_rewrite_prompt(query: str) -> str:
+    return str("You are a helpful assistant to Canvas Learning Management System users. " +
+        "Complete the empty V1, V2, & V3 below and respond ONLY in plaintext WITHOUT the 'V1' 'V2' & 'V3'" +
+        "QUESTION: How do I find my course? " +
+        "V1: How do I access the Canvas dashboard? " +
+        "V2: How do I log into Canvas? " +
+        "V3: How do I find all my Canvas courses? " +
+        f"QUESTION: {query}? " +
+        "V1: ___ ? " +
+        "V2: ___ ? " +
+        "V3: ___ ? ")
+
+def build_answer_prompt(query: str, supporting_text: str) -> str:
+    # Build the prompt base on a already running Q&A format
+    return str("You are a helpful assistat for Canvas Learning Management System users. " +
+        "DO NOT IGNORE ANY OF THESE INSTRUCTIONS. " +
+        "DO NOT REPLY WITH QUESTIONS. ONLY MAKE HELPFUL STATEMENTS. " +
+        "Provide a markdown response that ONLY completes the next 'ANSWER:' in the following conversation:: " +
+        "QUESTION: I have a question about Canvas. " +
+        "EVIDENCE: The user wants help with Canvas. We should respond in a helpful tone." +
+        "ANSWER: I am happy to help. What is your question? " +
+        f"QUESTION: {query} " +
+        f"EVIDENCE: {supporting_text}\n" +
+        "ANSWER: ")
+
+def cancel_tasks(*tasks: asyncio.Task | None):
+    """
+    Cancels outstanding tasks whose results are no longer needed
+    """
+    for task in tasks:
+        if task is None:
+            continue
+        if task.done():
+            # Retrieve the exception so it is not reported as unhandled
+            if not task.cancelled():
+                task.exception()
+            continue
+        task.cancel()
+
+def answer_chunk_id(match: Match) -> str | None:
+    """
+    Returns the id of the answer chunk for a forum question chunk
+    """
+    if match.metadata.answer_id is not None:
+        return match.metadata.answer_id
+    # Vectors stored before the pipeline linked answers
+    if match.id.split("-")[1] == "0" and match.metadata.text.startswith("Question"):
+        return match.id.split("-")[0] + "-1"
+    return None
+
+def split_rewrites(text: str) -> list[str]:
+    """
+    Splits the rewrite response into separate questions
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(lines) <= 1:
+        # Sometimes all three come back on one line
+        lines = [part.strip() for part in re.split(r"(?<=\?)\s+", text) if part.strip()]
+    # Drop any 'V1:' style labels the model kept
+    rewrites = [re.sub(r"^V\d\s*:\s*", "", line) for line in lines]
+    return [rewrite for rewrite in rewrites if rewrite][:MAX_REWRITES]
+
+def reciprocal_rank_fusion(results: list[list[Match]], top_k: int) -> list[Match]:
+    """
+    Merges ranked result lists, scoring each chunk by the sum of 1 / (k + rank)
+    over the lists it appears in. Duplicates keep their best similarity score,
+    which the relevance thresholds downstream still use.
+    """
+    fused: dict[str, float] = {}
+    best: dict[str, Match] = {}
+    for matches in results:
+        for rank, match in enumerate(matches):
+            fused[match.id] = fused.get(match.id, 0.0) + 1.0 / (RRF_K + rank + 1)
+            if match.id not in best or match.score > best[match.id].score:
+                best[match.id] = match
+    ranked = sorted(fused, key=fused.get, reverse=True)
+    return [best[id] for id in ranked[:top_k]]
+
+async def fan_out_search(rewrites: list[str], raw_embeddings: ndarray, raw_matches: list[Match] | None) -> list[Match]:
+    """
+    Encodes the rewrites in one batch, searches for each of them and the raw
+    query concurrently and fuses the results
+    """
+    embeddings = await embedding.extract_embeddings_many_async(rewrites)
+    searches = [vectordb.query_similar_async(vector.tolist()) for vector in embeddings]
+    if raw_matches is None:
+        searches.append(vectordb.query_similar_async(raw_embeddings.tolist()))
+    results = list(await asyncio.gather(*searches))
+    if raw_matches is not None:
+        results.append(raw_matches)
+    return reciprocal_rank_fusion(results, vectordb.TOP_K)
+
+def score_margin(matches: list[Match]) -> tuple[float, float]:
+    """
+    Returns the top score and how far it is above the second best
+    """
+    if len(matches) == 0:
+        return 0.0, 0.0
+    scores = sorted((match.score for match in matches), reverse=True) + [0.0]
+    return scores[0], scores[0] - scores[1]
+
+def is_confident(matches: list[Match]) -> bool:
+    top, margin = score_margin(matches)
+    if top >= REWRITE_SURE_SCORE:
+        # Near duplicates score alike, so a close runner-up is no doubt here
+        return True
+    return top >= REWRITE_MIN_SCORE and margin >= REWRITE_MIN_MARGIN
+
+def stats() -> dict:
+    return {"mode": RETRIEVAL_MODE, "paths": dict(path_counts), "coalescing": flights.stats()}
+
+async def replace_question_chunks(matches: list[Match]) -> list[str]:
+    """
+    Replaces forum question chunks with their answer chunks using one batched
+    lookup. Returns the ids of all chunks used.
+    """
+    chunk_ids = []
+    answer_ids = {}
+    for i, match in enumerate(matches):
+        chunk_ids.append(match.id)
+        if match.score < 0.75:
+            continue
+        answer_id = answer_chunk_id(match)
+        if answer_id is None:
+            continue
+        log.info(f"Found question chunk returned. Replacing chunk {match.id} with an answer")
+        answer_ids[i] = answer_id
+
+    answers = await vectordb.get_chunks_async(list(set(answer_ids.values())))
+
+    for i, answer_id in answer_ids.items():
+        if answer_id not in answers:
+            log.warn(f"Answer chunk {answer_id} not found")
+            continue
+        log.info(f"Found answer chunk {answer_id}")
+        chunk_ids.append(answer_id)
+        matches[i].id = answer_id
+        matches[i].metadata = answers[answer_id]
+
+    return chunk_ids
+
+def flight_key(query: str) -> str:
+    """
+    Sanitized queries differing only in case or spacing are the same question
+    """
+    return " ".join(query.lower().split())
+
+async def admit(query: str) -> tuple[str, Retrieval | None]:
+    """
+    Sanitizes the query and waits out a cold start. Returns the sanitized
+    query, and a Retrieval with the answer set when it is rejected.
+    """
+    try:
+        query = sanitize.sanitize_query(query)
+    except:
+        log.warn("Query sanitization failed. Rejecting...")
+        return query, Retrieval(query=query, answer=REJECTED_ANSWER)
+
+    # Requests arriving during a cold start wait for the model and clients
+    await startup.wait_ready(*startup.QUERY_DEPENDENCIES)
+    return query, None
+
+async def with_captcha(captcha_token: str, remote_ip: str | None, work: Callable[[], Awaitable[Any]]) -> Any | None:
+    """
+    Starts the work speculatively while the captcha is verified, so the
+    embedding, cache lookup and rewrite overlap the siteverify round trip.
+    Returns the work's result, or None when the captcha fails. A failed
+    request detaches from the work, and SingleFlight cancels the work when
+    that request was its only waiter.
+    """
+    work_task = asyncio.create_task(work())
+    try:
+        verified = await captcha.verify_async(captcha_token, remote_ip)
+    except asyncio.CancelledError:
+        cancel_tasks(work_task)
+        raise
+    except Exception as err:
+        log.error(f"Captcha verification failed: {err}")
+        verified = False
+
+    if not verified:
+        cancel_tasks(work_task)
+        return None
+    return await work_task
+
+async def retrieve(query: str, captcha_token: str, remote_ip: str | None = None) -> tuple[str, Retrieval]:
+    """
+    Runs every stage up to the answer prompt and returns the sanitized query
+    with the result. Concurrent identical queries share the result, so
+    callers must not modify it.
+    """
+    query, rejected = await admit(query)
+    if rejected is not None:
+        return query, rejected
+    retrieval = await with_captcha(captcha_token, remote_ip,
+        lambda: flights.do(("retrieve", flight_key(query)), lambda: shared_search(query)))
+    if retrieval is None:
+        return query, Retrieval(query=query, answer=CAPTCHA_FAILED_ANSWER)
+    return query, retrieval
+
+async def answer(query: str, captcha_token: str, remote_ip: str | None = None) -> tuple[Retrieval, str]:
+    """
+    Retrieves and generates the answer. Concurrent identical queries share
+    both, and the answer is cached once, but each request is logged with
+    its own question.
+    """
+    query, rejected = await admit(query)
+    if rejected is not None:
+        return rejected, rejected.answer
+
+    result = await with_captcha(captcha_token, remote_ip,
+        lambda: flights.do(("answer", flight_key(query)), lambda: generate(query)))
+    if result is None:
+        return Retrieval(query=query, answer=CAPTCHA_FAILED_ANSWER), CAPTCHA_FAILED_ANSWER
+    retrieval, answer = result
+    if retrieval.prompt is not None or retrieval.cached:
+        await log_answer(query, retrieval, answer)
+    return retrieval, answer
+
+async def shared_search(query: str) -> Retrieval:
+    async with admission.queries.slot():
+        return await search(query)
+
+async def generate(query: str) -> tuple[Retrieval, str]:
+    async with admission.queries.slot():
+        retrieval = await search(query)
+        if retrieval.prompt is None:
+            return retrieval, retrieval.answer
+        answer = await llm.query_llm_async(retrieval.prompt, stage="llm_answer")
+        await store(retrieval, answer)
+        return retrieval, answer
+
+async def lookup(query: str) -> tuple[ndarray, Retrieval | None]:
+    """
+    Embeds the raw query and checks the semantic cache with it
+    """
+    raw_embeddings = await embedding.extract_embeddings_async(query)
+    if semantic_cache is None:
+        return raw_embeddings, None
+    cached = await semantic_cache.lookup_async(raw_embeddings)
+    if cached is None:
+        return raw_embeddings, None
+    log.info("Semantic cache hit. Skipping retrieval and answer generation")
+    return raw_embeddings, Retrieval(query=query, answer=cached.answer, sources=cached.sources,
+        chunk_ids=cached.chunk_ids, cached=True)
+
+async def search(query: str) -> Retrieval:
+    """
+    Runs the semantic cache lookup, query rewrite, embedding and vector
+    search on a sanitized query, then builds the answer prompt
+    """
+    # The raw query embedding and, in rewrite mode, the rewrite do not
+    # depend on each other, so they run at once. In adaptive mode the
+    # rewrite only starts once the raw query results turn out weak.
+    log.info("Querying", query=query)
+    rewrite_task = None
+    if RETRIEVAL_MODE == "rewrite":
+        rewrite_task = asyncio.create_task(llm.query_llm_async(build_rewrite_prompt(query), stage="llm_rewrite"))
+
+    try:
+        raw_embeddings, cached = await lookup(query)
+        if cached is not None:
+            cancel_tasks(rewrite_task)
+            return cached
+
+        matches = None
+        search_embeddings = None
+        if rewrite_task is None:
+            matches = await vectordb.query_similar_async(raw_embeddings.tolist())
+            top, margin = score_margin(matches)
+            if is_confident(matches):
+                path = "raw"
+            else:
+                log.info("Raw query results are weak", top=round(top, 3), margin=round(margin, 3))
+                rewrite_task = asyncio.create_task(llm.query_llm_async(build_rewrite_prompt(query), stage="llm_rewrite"))
+
+        if rewrite_task is not None:
+            log.info("Retrieving additional queries")
+            try:
+                additional_queries = await rewrite_task
+                log.info("Found new queries", rewrites=additional_queries)
+                rewrites = split_rewrites(additional_queries)
+                if QUERY_FUSION == "rrf" and len(rewrites) > 0:
+                    matches = await fan_out_search(rewrites, raw_embeddings, matches)
+                else:
+                    query_embeddings = await embedding.extract_embeddings_async(str(query + additional_queries))
+                    matches = await vectordb.query_similar_async(query_embeddings.tolist())
+                    search_embeddings = query_embeddings
+                path = "rewrite"
+            except Exception as err:
+                # Fall back to the raw query, which may already be searched
+                log.warn(f"Query rewrite failed. Using original query: {err}")
+                path = "rewrite_failed"
+                if matches is None:
+                    matches = await vectordb.query_similar_async(raw_embeddings.tolist())
+    except BaseException:
+        cancel_tasks(rewrite_task)
+        raise
+
+    path_counts[path] += 1
+    paths.inc(path=path)
+    top, margin = score_margin(matches)
+    log.info("Retrieval finished", path=path, top=round(top, 3), margin=round(margin, 3))
+
+    # Exact product terms the embedding may miss are found by keyword.
+    # Those chunks are scored against the raw query, or the combined query
+    # when that is what was searched.
+    vector = search_embeddings if search_embeddings is not None else raw_embeddings
+    matches = lexical.blend(query, matches, vectordb.TOP_K, vector)
+    for match in matches:
+        match_scores.observe(match.score)
+
+    # If forum questions are returned, replace with answers
+    chunk_ids = await replace_question_chunks(matches)
+
+    # Discard low quality matches
+    relevant = [match for match in matches if match.score >= 0.50]
+
+    # If no relevant info received, return canned "I don't know" message
+    if len(relevant) == 0:
+        return Retrieval(query=query, answer=NOT_FOUND_ANSWER, path=path)
+
+    supporting = evidence.build_evidence(relevant)
+    source_urls = set()
+    sources = []
+    for match in supporting.matches:
+        if match.metadata.source_url not in source_urls:
+            source_urls.add(match.metadata.source_url)
+            sources.append({"url":str(match.metadata.source_url), "title":match.metadata.source_url_title, "score":match.score})
+
+    prompt = build_answer_prompt(query, supporting.text())
+    prompt_tokens = evidence.estimate_tokens(prompt)
+    prompt_sizes.observe(prompt_tokens)
+    log.info("Built answer prompt", prompt_tokens=prompt_tokens, evidence_chunks=len(supporting.matches),
+        duplicates=supporting.duplicates, over_budget=supporting.trimmed)
+
+    return Retrieval(query=query, prompt=prompt, sources=sources, chunk_ids=chunk_ids,
+        cache_key=raw_embeddings, path=path, prompt_tokens=prompt_tokens)
+
+async def log_answer(query: str, retrieval: Retrieval, answer: str):
+    """
+    Logs an answered question. The query is the request's own, since
+    coalesced requests share a retrieval built from the first one's.
+    """
+    try:
+        await events.log_qa_async(question=query, chunk_ids=str(retrieval.chunk_ids), answer=answer)
+    except Exception as err:
+        log.error(f"Failed to log question and answer: {err}")
+
+async def store(retrieval: Retrieval, answer: str):
+    """
+    Stores a freshly generated answer in the semantic cache
+    """
+    if semantic_cache is None or retrieval.cached or retrieval.cache_key is None:
+        return
+    cache_key = retrieval.cache_key
+    # Coalesced streams share the retrieval, so only the first answer is stored
+    retrieval.cache_key = None
+    try:
+        await semantic_cache.store_async(cache_key, answer, retrieval.sources, retrieval.chunk_ids)
+    except Exception as err:
+        log.error(f"Failed to cache answer: {err}")
+
+async def record(query: str, retrieval: Retrieval, answer: str):
+    """
+    Logs an answered question and stores freshly generated answers in the
+    semantic cache
+    """
+    await log_answer(query, retrieval, answer)
+    await store(retrieval, answer)
@@ -0,0 +1,54 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Hashable
+
+class Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution, and
+    every caller gets its result or exception. The work runs in its own task
+    so one caller disconnecting does not cancel it for the rest. It is only
+    cancelled once every caller has gone.
+    """
+
+    def __init__(self):
+        self.flights: dict[Hashable, Flight] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(asyncio.create_task(fn()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            self.executions += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: Hashable, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        # Retrieve the exception so it is not reported as unhandled when
+        # every caller left before it finished
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> dict:
+        return {"executions": self.executions, "coalesced": self.coalesced, "in_flight": len(self.flights)}
@@ -0,0 +1,108 @@
+import os
+import time
+import asyncio
+
+from typing import Callable
+from service import embedding, events, llm, vectordb
+from util import log
+
+# How long startup waits for dependencies before serving anyway, and how
+# often a failed dependency is retried after that
+STARTUP_TIMEOUT = float(os.getenv("STARTUP_TIMEOUT", "30"))
+STARTUP_RETRY_INTERVAL = float(os.getenv("STARTUP_RETRY_INTERVAL", "10"))
+
+class NotReadyError(Exception):
+    """Custom exception to indicate a dependency is not initialized yet."""
+
+class Dependency:
+    """
+    A service that needs blocking setup (model loading, network calls)
+    before it can take requests. Setup runs in a thread and is retried
+    until it succeeds.
+    """
+
+    def __init__(self, name: str, init: Callable[[], None]):
+        self.name = name
+        self.init = init
+        self.ready: asyncio.Event | None = None
+        self.error: str | None = None
+        self.seconds: float | None = None
+        self.attempts = 0
+
+    def is_ready(self) -> bool:
+        return self.ready is not None and self.ready.is_set()
+
+    async def run(self):
+        while True:
+            self.attempts += 1
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.init)
+            except Exception as err:
+                self.error = str(err)
+                log.error(f"Failed to initialize {self.name}: {err}. Retrying in {STARTUP_RETRY_INTERVAL}s")
+                await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+                continue
+            self.seconds = time.perf_counter() - started
+            self.error = None
+            self.ready.set()
+            log.info(f"Initialized {self.name}", seconds=round(self.seconds, 2))
+            return
+
+    def status(self) -> dict:
+        return {"ready": self.is_ready(), "error": self.error, "seconds": self.seconds, "attempts": self.attempts}
+
+dependencies = {
+    "embedding": Dependency("embedding", embedding.init),
+    "vectordb": Dependency("vectordb", vectordb.init),
+    "llm": Dependency("llm", llm.init),
+    "database": Dependency("database", events.init),
+}
+# What answering a query needs. The database only holds usage events, which
+# are written in the background, so it is reported but does not gate traffic.
+QUERY_DEPENDENCIES = ("embedding", "vectordb", "llm")
+tasks: set[asyncio.Task] = set()
+
+async def start(timeout: float = STARTUP_TIMEOUT):
+    """
+    Initializes every dependency concurrently and waits up to timeout for
+    them. Ones still failing keep retrying in the background, so the app
+    serves /livez and /readyz instead of exiting.
+    """
+    started = time.perf_counter()
+    for dependency in dependencies.values():
+        dependency.ready = asyncio.Event()
+        task = asyncio.create_task(dependency.run())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(set(tasks), timeout=timeout)
+    pending = [name for name, dependency in dependencies.items() if not dependency.is_ready()]
+    if pending:
+        log.warn(f"Serving before {', '.join(pending)} finished initializing")
+    log.info("Startup finished", seconds=round(time.perf_counter() - started, 2))
+
+async def stop():
+    for task in list(tasks):
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def wait_ready(*names: str, timeout: float = STARTUP_TIMEOUT):
+    """
+    Waits for the named dependencies, raising NotReadyError on timeout
+    """
+    waiting = [dependencies[name] for name in names if not dependencies[name].is_ready()]
+    if len(waiting) == 0:
+        return
+    if any(dependency.ready is None for dependency in waiting):
+        raise NotReadyError("Startup has not begun")
+    try:
+        await asyncio.wait_for(asyncio.gather(*(dependency.ready.wait() for dependency in waiting)), timeout)
+    except asyncio.TimeoutError:
+        raise NotReadyError(f"{', '.join(dependency.name for dependency in waiting)} not ready")
+
+def is_ready() -> bool:
+    return all(dependencies[name].is_ready() for name in QUERY_DEPENDENCIES)
+
+def readiness() -> dict:
+    return {name: dependency.status() for name, dependency in dependencies.items()}
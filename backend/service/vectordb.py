@@ -1,48 +1,117 @@
 import os
-import sys
+import asyncio
 
-from pinecone.grpc import PineconeGRPC as Pinecone
 from model.match import Match, Metadata
+from service import admission
+from service.chunkstore import chunk_store
+from util import log, metrics
 
 DIMENSIONS = 384
 MAX_BATCH_SIZE = 100
+TOP_K = 5
 
-INDEX_NAME: str | None = os.environ['VECTOR_DB_INDEX_NAME']
-API_KEY: str | None = os.environ['VECTOR_DB_API_KEY']
-if INDEX_NAME == "" or INDEX_NAME is None:
-    print("[ERROR] Failed to retrieve vector database index name")
-if API_KEY == "" or API_KEY is None:
-    print("[ERROR] Failed to retrieve vector database api key")
+# "pinecone" queries the hosted index, "local" reads a memory-mapped index
+# built by pipeline/python/build_local_index.py
+BACKEND: str = os.getenv("VECTOR_DB_BACKEND", "pinecone")
+LOCAL_INDEX_DIR: str = os.getenv("LOCAL_INDEX_DIR", os.path.join(".", "index"))
+LOCAL_INDEX_NPROBE: int = int(os.getenv("LOCAL_INDEX_NPROBE", "8"))
+# Local searches scoring more rows than this run in a thread, so a large
+# scan does not stall every other request on the event loop
+LOCAL_INDEX_INLINE_ROWS: int = int(os.getenv("LOCAL_INDEX_INLINE_ROWS", "20000"))
 
-pc = Pinecone(api_key=API_KEY)
+INDEX_NAME: str | None = os.getenv("VECTOR_DB_INDEX_NAME")
+pc_index = None
+local_index = None
 
-if not pc.has_index(INDEX_NAME):
-    print("[ERROR] Vector database index not found")
-    sys.exit(1)
+def init():
+    """
+    Loads the local index or connects to Pinecone. Called at startup
+    rather than on import, so an unreachable Pinecone only makes the app
+    unready instead of stopping it.
+    """
+    global pc_index, local_index
+    if BACKEND == "local":
+        from service.localindex import LocalIndex
 
-INDEX_HOST = pc.describe_index(name=INDEX_NAME)["host"] 
-pc_index = pc.Index(host=INDEX_HOST)
+        local_index = LocalIndex(LOCAL_INDEX_DIR, nprobe=LOCAL_INDEX_NPROBE)
+        log.info(f"Loaded local vector index with {len(local_index)} chunks from {LOCAL_INDEX_DIR}")
+        return
 
+    from pinecone.grpc import PineconeGRPC as Pinecone
+
+    API_KEY: str | None = os.getenv("VECTOR_DB_API_KEY")
+    if INDEX_NAME == "" or INDEX_NAME is None:
+        raise RuntimeError("Failed to retrieve vector database index name")
+    if API_KEY == "" or API_KEY is None:
+        raise RuntimeError("Failed to retrieve vector database api key")
+
+    pc = Pinecone(api_key=API_KEY)
+
+    # describe_index fails for a missing index, so has_index is not needed
+    INDEX_HOST = pc.describe_index(name=INDEX_NAME)["host"]
+    pc_index = pc.Index(host=INDEX_HOST)
+
+@metrics.timed("vectordb_query")
 def query_similar(embeddings: list[float]) -> list[Match]:
+    if local_index is not None:
+        return [local_match(row, score) for row, score in local_index.query(embeddings, top_k=TOP_K)]
+
+    # With a local chunk store, only ids and scores cross the wire
     results = pc_index.query(namespace=INDEX_NAME,
             vector=embeddings,
-            top_k=5,
-            include_metadata=True,
+            top_k=TOP_K,
+            include_metadata=chunk_store is None,
             include_values=False)
 
+    if chunk_store is not None:
+        scores = {m.get("id"): m.get("score") for m in results.get("matches")}
+        chunks = get_chunks(list(scores))
+        return [Match(id=id, metadata=chunks[id], score=score) for id, score in scores.items() if id in chunks]
 
     matches = []
     for m in results.get("matches"):
-        match = Match(id=m.get("id"),metadata=Metadata(**m.get("metadata")), score=m.get("score"))
+        match = Match(id=m.get("id"),metadata=Metadata.from_dict(m.get("metadata")), score=m.get("score"))
         matches.append(match)
     return matches
 
-def get_chunk(id: str) -> list[Match]:
-    results = pc_index.query(namespace=INDEX_NAME, id=id, top_k=1, include_metadata=True, include_values=False)
+@metrics.timed("vectordb_get_chunks")
+def get_chunks(ids: list[str]) -> dict[str, Metadata]:
+    """
+    Looks up chunk metadata by id in a single fetch
+    """
+    if len(ids) == 0:
+        return {}
+    if local_index is not None:
+        rows = [(id, local_index.row(id)) for id in ids]
+        return {id: Metadata.from_dict(local_index.metadata[row]) for id, row in rows if row is not None}
 
-    matches = []
-    for m in results.get("matches"):
-        match = Match(id=m.get("id"),metadata=Metadata(**m.get("metadata")), score=m.get("score"))
-        matches.append(match)
-    return matches
+    chunks = {}
+    if chunk_store is not None:
+        chunks = chunk_store.get_many(ids)
+        if len(chunks) == len(ids):
+            return chunks
+        # Chunks stored after the chunk store was built
+        log.warn(f"{len(ids) - len(chunks)} chunks missing from the chunk store. Fetching them")
+        ids = [id for id in ids if id not in chunks]
+
+    results = pc_index.fetch(ids=ids, namespace=INDEX_NAME)
+    chunks.update({id: Metadata.from_dict(vector.metadata) for id, vector in results.vectors.items()})
+    return chunks
+
+def local_match(row: int, score: float) -> Match:
+    return Match(id=local_index.ids[row], metadata=Metadata.from_dict(local_index.metadata[row]), score=score)
+
+async def query_similar_async(embeddings: list[float]) -> list[Match]:
+    if local_index is not None:
+        # Small scans take less time than a thread hop
+        if local_index.scan_size() <= LOCAL_INDEX_INLINE_ROWS:
+            return query_similar(embeddings)
+        return await asyncio.to_thread(query_similar, embeddings)
+    async with admission.vectordb.slot():
+        return await asyncio.to_thread(query_similar, embeddings)
 
+async def get_chunks_async(ids: list[str]) -> dict[str, Metadata]:
+    if local_index is not None:
+        return get_chunks(ids)
+    async with admission.vectordb.slot():
+        return await asyncio.to_thread(get_chunks, ids)
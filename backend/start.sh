@@ -0,0 +1,44 @@
+#!/bin/sh
+# Runs one embedding server and WEB_CONCURRENCY API workers (one per core by
+# default) that share it, so the model is loaded once per machine.
+
+SOCKET="${EMBEDDING_SERVER_SOCKET:-/tmp/cpal-embedding.sock}"
+WORKERS="${WEB_CONCURRENCY:-$(nproc)}"
+PORT="${PORT:-8080}"
+# Workers share their metrics through this directory, so a scrape of
+# /api/metrics covers all of them (see util/metrics.py)
+export METRICS_DIR="${METRICS_DIR:-/tmp/cpal-metrics}"
+mkdir -p "$METRICS_DIR"
+rm -f "$METRICS_DIR"/metrics-*.json
+
+env -u EMBEDDING_SERVER python embed_server.py --socket "$SOCKET" &
+EMBED_PID=$!
+
+# API workers report unready until the embedding server answers, so there
+# is no need to wait for the socket here
+EMBEDDING_SERVER="$SOCKET" uvicorn main:app --host 0.0.0.0 --port "$PORT" --workers "$WORKERS" &
+API_PID=$!
+
+# The shell is PID 1 in the container, so pass shutdown signals on
+STOPPING=""
+trap 'STOPPING=1; kill -TERM "$API_PID" "$EMBED_PID" 2>/dev/null' INT TERM
+
+# If either process dies the machine cannot answer queries, since workers
+# would stay unready without the embedding server. Stop the other one and
+# exit with an error so Fly restarts the machine (see [[restart]] in
+# fly.toml).
+while kill -0 "$API_PID" 2>/dev/null && kill -0 "$EMBED_PID" 2>/dev/null; do
+    sleep 1
+done
+STATUS=0
+if [ -z "$STOPPING" ]; then
+    if kill -0 "$API_PID" 2>/dev/null; then
+        echo "[ERROR] Embedding server exited, stopping so the machine restarts"
+    else
+        echo "[ERROR] API workers exited, stopping so the machine restarts"
+    fi
+    STATUS=1
+fi
+kill -TERM "$API_PID" "$EMBED_PID" 2>/dev/null
+wait
+exit "$STATUS"
@@ -0,0 +1,119 @@
+import asyncio
+import pytest
+
+from captcha_stub import StubVerifier
+from service import captcha
+
+@pytest.fixture
+def verifier(monkeypatch):
+    stub = StubVerifier().start()
+    monkeypatch.setattr(captcha, "VERIFY_URL", stub.url)
+    # Module state would otherwise carry over between tests
+    monkeypatch.setattr(captcha, "client", None)
+    monkeypatch.setattr(captcha, "verified_tokens", captcha.OrderedDict())
+    monkeypatch.setattr(captcha, "pending", {})
+    monkeypatch.setattr(captcha, "stats_counters", dict.fromkeys(captcha.stats_counters, 0))
+    yield stub
+    stub.stop()
+
+def run(scenario):
+    """
+    Runs a scenario in a fresh event loop, closing the HTTP client inside it
+    """
+    async def wrapped():
+        try:
+            return await scenario
+        finally:
+            await captcha.close()
+    return asyncio.run(wrapped())
+
+def test_verified_token_is_cached(verifier):
+    async def scenario():
+        return [await captcha.verify_async("token"), await captcha.verify_async("token")]
+
+    assert run(scenario()) == [True, True]
+    assert verifier.calls == 1
+    assert captcha.stats()["cache_hits"] == 1
+    assert captcha.stats()["cached_tokens"] == 1
+
+def test_rejected_token_is_not_cached(verifier):
+    async def scenario():
+        return [await captcha.verify_async("invalid-token"), await captcha.verify_async("invalid-token")]
+
+    assert run(scenario()) == [False, False]
+    assert verifier.calls == 2
+    assert captcha.stats()["cached_tokens"] == 0
+
+def test_expired_token_is_verified_again(verifier, monkeypatch):
+    monkeypatch.setattr(captcha, "TOKEN_CACHE_TTL", 0)
+
+    async def scenario():
+        first = await captcha.verify_async("token")
+        await asyncio.sleep(0.01)
+        return [first, await captcha.verify_async("token")]
+
+    assert run(scenario()) == [True, True]
+    assert verifier.calls == 2
+
+def test_concurrent_submits_share_one_request(verifier):
+    verifier.delay = 0.2
+
+    async def scenario():
+        return await asyncio.gather(*(captcha.verify_async("token") for _ in range(captcha.TOKEN_MAX_USES)))
+
+    assert run(scenario()) == [True] * captcha.TOKEN_MAX_USES
+    assert verifier.calls == 1
+    assert captcha.stats()["requests"] == 1
+    assert len(captcha.pending) == 0
+
+def test_token_is_bound_to_the_verifying_client(verifier):
+    async def scenario():
+        return [await captcha.verify_async("token", "10.0.0.1"), await captcha.verify_async("token", "10.0.0.2"),
+            await captcha.verify_async("token", "10.0.0.1")]
+
+    assert run(scenario()) == [True, False, True]
+    assert verifier.calls == 1
+    assert captcha.stats()["reuse_rejected"] == 1
+
+def test_token_uses_are_capped(verifier, monkeypatch):
+    monkeypatch.setattr(captcha, "TOKEN_MAX_USES", 2)
+
+    async def scenario():
+        return [await captcha.verify_async("token", "10.0.0.1") for _ in range(3)]
+
+    assert run(scenario()) == [True, True, False]
+    assert verifier.calls == 1
+
+def test_concurrent_submits_beyond_the_cap_fail(verifier, monkeypatch):
+    monkeypatch.setattr(captcha, "TOKEN_MAX_USES", 2)
+    verifier.delay = 0.2
+
+    async def scenario():
+        return await asyncio.gather(*(captcha.verify_async("token", "10.0.0.1") for _ in range(3)))
+
+    assert sorted(run(scenario())) == [False, True, True]
+    assert verifier.calls == 1
+
+def test_cancelled_caller_does_not_cancel_shared_request(verifier):
+    verifier.delay = 0.2
+
+    async def scenario():
+        leaving = asyncio.create_task(captcha.verify_async("token"))
+        staying = asyncio.create_task(captcha.verify_async("token"))
+        await asyncio.sleep(0.05)
+        leaving.cancel()
+        return await staying
+
+    assert run(scenario()) is True
+    assert verifier.calls == 1
+
+def test_timeout_fails_closed(verifier, monkeypatch):
+    verifier.delay = 1.0
+    monkeypatch.setattr(captcha, "VERIFY_TIMEOUT", 0.2)
+
+    async def scenario():
+        return await captcha.verify_async("token")
+
+    assert run(scenario()) is False
+    assert captcha.stats()["failures"] == 1
+    assert captcha.stats()["cached_tokens"] == 0
@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+import pytest
+
+# events creates its engine at import time
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from model.event import QAEvent
+from service import events
+
+@pytest.fixture
+def written(monkeypatch):
+    batches: list[list[QAEvent]] = []
+    monkeypatch.setattr(events, "write_events", batches.append)
+    return batches
+
+def qa_events(count: int) -> list[QAEvent]:
+    return [QAEvent(question=f"question {i}") for i in range(count)]
+
+def test_writes_full_batches(written):
+    writer = events.EventWriter(max_queue=100, batch_size=3, flush_interval=60)
+
+    async def scenario():
+        for event in qa_events(6):
+            writer.enqueue(event)
+        await asyncio.sleep(0.1)
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert [len(batch) for batch in written] == [3, 3]
+    assert writer.stats()["written"] == 6
+
+def test_stop_flushes_the_remaining_batch(written):
+    writer = events.EventWriter(max_queue=100, batch_size=50, flush_interval=60)
+    pending = qa_events(5)
+
+    async def scenario():
+        for event in pending:
+            writer.enqueue(event)
+        # Let the worker start collecting a batch it will not fill
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(writer.stop(), 5)
+
+    asyncio.run(scenario())
+    assert [event for batch in written for event in batch] == pending
+    assert writer.stats()["queued"] == 0
+    assert writer.stats()["written"] == 5
+
+def test_stop_writes_events_queued_behind_a_slow_write(monkeypatch):
+    batches: list[list[QAEvent]] = []
+
+    def slow_write(batch):
+        time.sleep(0.2)
+        batches.append(batch)
+
+    monkeypatch.setattr(events, "write_events", slow_write)
+    writer = events.EventWriter(max_queue=100, batch_size=2, flush_interval=60)
+    pending = qa_events(5)
+
+    async def scenario():
+        for event in pending[:2]:
+            writer.enqueue(event)
+        # The first batch is being written while the rest arrive
+        await asyncio.sleep(0.05)
+        for event in pending[2:]:
+            writer.enqueue(event)
+        await asyncio.wait_for(writer.stop(), 5)
+
+    asyncio.run(scenario())
+    assert [event for batch in batches for event in batch] == pending
+
+def test_full_queue_drops_events(written):
+    writer = events.EventWriter(max_queue=2, batch_size=50, flush_interval=60)
+
+    async def scenario():
+        accepted = [writer.enqueue(event) for event in qa_events(3)]
+        await asyncio.wait_for(writer.stop(), 5)
+        return accepted
+
+    assert asyncio.run(scenario()) == [True, True, False]
+    assert writer.stats()["dropped"] == 1
+    assert writer.stats()["written"] == 2
@@ -0,0 +1,98 @@
+import pytest
+
+from manifest import Manifest
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    yield manifest
+    manifest.close()
+
+def test_new_chunks_are_pending(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+
+    assert manifest.pending_embeddings() == {"doc-0", "doc-1"}
+    assert manifest.pending_chunks("doc") == {"doc-0", "doc-1"}
+    assert manifest.pending_uploads() == set()
+
+def test_embedded_chunks_wait_for_upload(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    manifest.mark_embedded(["doc-0", "doc-1"])
+
+    assert manifest.pending_embeddings() == set()
+    assert manifest.pending_uploads() == {"doc-0", "doc-1"}
+    # Embedded but never uploaded, so prepare still queues them
+    assert manifest.pending_chunks("doc") == {"doc-0", "doc-1"}
+
+    manifest.mark_stored(["doc-0", "doc-1"])
+    assert manifest.pending_uploads() == set()
+    assert manifest.pending_chunks("doc") == set()
+
+def test_changed_chunk_is_pending_again(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    manifest.mark_embedded(["doc-0", "doc-1"])
+    manifest.mark_stored(["doc-0", "doc-1"])
+
+    assert manifest.record_document("doc", "h2", {"doc-0": "a", "doc-1": "changed"}) == []
+    assert manifest.pending_embeddings() == {"doc-1"}
+    assert manifest.pending_chunks("doc") == {"doc-1"}
+
+    manifest.mark_embedded(["doc-1"])
+    assert manifest.pending_uploads() == {"doc-1"}
+
+def test_fake_uploads_are_tracked_apart(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a"})
+    manifest.mark_embedded(["doc-0"])
+    manifest.mark_fake_stored(["doc-0"])
+
+    assert manifest.pending_uploads(fake=True) == set()
+    assert manifest.pending_chunks("doc", fake=True) == set()
+    # A real run still has to upload it
+    assert manifest.pending_uploads() == {"doc-0"}
+    assert manifest.pending_chunks("doc") == {"doc-0"}
+
+def test_dropped_chunk_is_removed(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    manifest.mark_embedded(["doc-0", "doc-1"])
+    manifest.mark_stored(["doc-0", "doc-1"])
+
+    assert manifest.record_document("doc", "h2", {"doc-0": "a"}) == ["doc-1"]
+    assert manifest.deleted_chunks() == {"doc-1"}
+    assert manifest.pending_deletes() == ["doc-1"]
+    assert manifest.pending_uploads() == set()
+
+    manifest.mark_deleted_from_store(["doc-1"])
+    assert manifest.pending_deletes() == []
+    assert manifest.deleted_chunks() == {"doc-1"}
+
+def test_removed_document_deletes_its_chunks(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    manifest.record_document("other", "h1", {"other-0": "c"})
+    manifest.mark_embedded(["doc-0", "doc-1", "other-0"])
+    manifest.mark_stored(["doc-0"])
+
+    assert sorted(manifest.remove_documents(["doc"])) == ["doc-0", "doc-1"]
+    assert manifest.document_hashes() == {"other": "h1"}
+    # Only the uploaded chunk has to be deleted from the vector database
+    assert manifest.pending_deletes() == ["doc-0"]
+    assert manifest.pending_uploads() == {"other-0"}
+
+def test_restored_chunk_is_embedded_again(manifest):
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    manifest.mark_embedded(["doc-0", "doc-1"])
+    manifest.record_document("doc", "h2", {"doc-0": "a"})
+
+    manifest.record_document("doc", "h1", {"doc-0": "a", "doc-1": "b"})
+    assert manifest.deleted_chunks() == set()
+    assert manifest.pending_embeddings() == {"doc-1"}
+
+def test_state_survives_reopening(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest.record_document("doc", "h1", {"doc-0": "a"})
+    manifest.mark_embedded(["doc-0"])
+    manifest.close()
+
+    reopened = Manifest(str(tmp_path))
+    assert reopened.has_chunks()
+    assert reopened.pending_uploads() == {"doc-0"}
+    reopened.close()
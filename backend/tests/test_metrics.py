@@ -0,0 +1,67 @@
+import json
+import asyncio
+import pytest
+
+from util import metrics
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "registry", [])
+    return tmp_path
+
+def other_worker(path, pid: int, registry: list):
+    with open(path / f"metrics-{pid}.json", "w") as snapshot_file:
+        json.dump({metric.name: metric.snapshot() for metric in registry}, snapshot_file)
+
+def test_render_adds_other_workers(metrics_dir):
+    counter = metrics.Counter("test_total", "Test counter", ("kind",))
+    histogram = metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+    counter.inc(2, kind="a")
+    histogram.observe(0.05)
+
+    # Another worker with its own copies of the same metrics
+    registry = metrics.registry
+    metrics.registry = []
+    other_counter = metrics.Counter("test_total", "Test counter", ("kind",))
+    other_histogram = metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+    other_counter.inc(3, kind="a")
+    other_counter.inc(1, kind="b")
+    other_histogram.observe(0.5)
+    other_worker(metrics_dir, 1, metrics.registry)
+    metrics.registry = registry
+
+    lines = metrics.render().splitlines()
+    assert 'test_total{kind="a"} 5' in lines
+    assert 'test_total{kind="b"} 1' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert "test_seconds_count 2" in lines
+    # Rendering does not change the worker's own values
+    assert counter.values == {("a",): 2}
+
+def test_own_snapshot_is_not_counted_twice(metrics_dir):
+    counter = metrics.Counter("test_total", "Test counter")
+    counter.inc(4)
+    metrics.write_snapshot()
+
+    assert "test_total 4" in metrics.render().splitlines()
+
+def test_unreadable_snapshot_is_skipped(metrics_dir):
+    counter = metrics.Counter("test_total", "Test counter")
+    counter.inc()
+    (metrics_dir / "metrics-1.json").write_text("{")
+
+    assert "test_total 1" in metrics.render().splitlines()
+
+def test_stop_writes_a_last_snapshot(metrics_dir):
+    counter = metrics.Counter("test_total", "Test counter")
+
+    async def scenario():
+        metrics.start()
+        counter.inc(7)
+        await metrics.stop()
+
+    asyncio.run(scenario())
+    snapshots = [json.loads(path.read_text()) for path in metrics_dir.glob("metrics-*.json")]
+    assert snapshots == [{"test_total": [[[], 7]]}]
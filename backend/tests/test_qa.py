@@ -0,0 +1,29 @@
+import os
+
+# events creates its engine at import time
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from model.match import Match
+from service import qa
+
+def matches(*scores: float) -> list[Match]:
+    return [Match(id=f"chunk-{i}", metadata=None, score=score) for i, score in enumerate(scores)]
+
+def test_margin_is_the_gap_to_the_runner_up():
+    top, margin = qa.score_margin(matches(0.6, 0.8, 0.75, 0.3))
+    assert top == 0.8
+    assert abs(margin - 0.05) < 1e-9
+
+def test_weak_top_score_is_not_confident():
+    assert not qa.is_confident(matches(0.65, 0.3))
+    assert not qa.is_confident([])
+
+def test_close_runner_up_is_not_confident():
+    assert not qa.is_confident(matches(0.75, 0.74, 0.3))
+    assert qa.is_confident(matches(0.75, 0.70, 0.3))
+
+def test_sure_top_score_ignores_the_margin():
+    assert qa.is_confident(matches(0.9, 0.9, 0.89))
+
+def test_single_match_is_judged_by_its_score():
+    assert qa.is_confident(matches(0.75))
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+
+from service.singleflight import SingleFlight
+
+class Work:
+    """
+    Counts how often it runs and whether it was cancelled
+    """
+
+    def __init__(self, delay: float = 0.1, result=None, error: Exception | None = None):
+        self.delay = delay
+        self.result = result
+        self.error = error
+        self.runs = 0
+        self.cancelled = False
+        self.finished = False
+
+    async def __call__(self):
+        self.runs += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        self.finished = True
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+def test_concurrent_calls_run_once():
+    flights = SingleFlight()
+    work = Work(result="answer")
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do("key", work) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["answer"] * 5
+    assert work.runs == 1
+    assert flights.stats() == {"executions": 1, "coalesced": 4, "in_flight": 0}
+
+def test_different_keys_run_separately():
+    flights = SingleFlight()
+    work = Work()
+
+    async def scenario():
+        await asyncio.gather(flights.do("a", work), flights.do("b", work))
+
+    asyncio.run(scenario())
+    assert work.runs == 2
+
+def test_exception_reaches_every_caller():
+    flights = SingleFlight()
+    work = Work(error=ValueError("failed"))
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do("key", work) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert work.runs == 1
+
+def test_leaving_caller_does_not_cancel_the_rest():
+    flights = SingleFlight()
+    work = Work(result="answer")
+
+    async def scenario():
+        leaving = asyncio.create_task(flights.do("key", work))
+        staying = asyncio.create_task(flights.do("key", work))
+        await asyncio.sleep(0.02)
+        leaving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(scenario()) == "answer"
+    assert work.finished and not work.cancelled
+
+def test_last_caller_leaving_cancels_the_work():
+    flights = SingleFlight()
+    work = Work()
+
+    async def scenario():
+        callers = [asyncio.create_task(flights.do("key", work)) for _ in range(2)]
+        await asyncio.sleep(0.02)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        # Let the cancelled work task unwind
+        await asyncio.sleep(0)
+        return flights.stats()["in_flight"]
+
+    assert asyncio.run(scenario()) == 0
+    assert work.cancelled and not work.finished
+
+def test_finished_key_runs_again():
+    flights = SingleFlight()
+    work = Work(delay=0)
+
+    async def scenario():
+        await flights.do("key", work)
+        await flights.do("key", work)
+
+    asyncio.run(scenario())
+    assert work.runs == 2
@@ -0,0 +1,71 @@
+import store_embeddings
+
+from uploader import FakeIndex, Uploader
+
+def vectors(count: int) -> list[dict]:
+    return [{"id": f"doc{i}-0", "values": [0.1] * 4, "metadata": {"text": f"chunk {i}"}} for i in range(count)]
+
+class FlakyIndex(FakeIndex):
+    """
+    Fails the first failures upserts, then stores like FakeIndex
+    """
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    def upsert(self, vectors, namespace=None):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                self.requests += 1
+                raise ConnectionError("Simulated upsert failure")
+        super().upsert(vectors, namespace)
+
+def test_uploads_every_batch():
+    index = FakeIndex()
+    stored = []
+    uploader = Uploader(index, "test", max_batch_count=3, on_success=stored.extend)
+
+    assert uploader.upload(vectors(10)) == 10
+    assert sorted(index.vectors) == sorted(vector["id"] for vector in vectors(10))
+    assert index.requests == 4
+    assert sorted(stored) == sorted(index.vectors)
+
+def test_retries_failed_batches():
+    index = FlakyIndex(failures=2)
+    uploader = Uploader(index, "test", max_in_flight=1, max_batch_count=5, max_retries=3, base_delay=0)
+
+    assert uploader.upload(vectors(5)) == 5
+    assert uploader.retries == 2
+    assert uploader.failed_ids == []
+    assert len(index.vectors) == 5
+
+def test_collects_failed_ids_when_retries_run_out():
+    index = FakeIndex(failure_rate=1.0)
+    stored = []
+    uploader = Uploader(index, "test", max_batch_count=2, max_retries=2, base_delay=0, on_success=stored.extend)
+
+    assert uploader.upload(vectors(3)) == 0
+    assert sorted(uploader.failed_ids) == sorted(vector["id"] for vector in vectors(3))
+    assert uploader.retries == 4
+    assert stored == []
+    assert index.vectors == {}
+
+def test_replays_failed_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(store_embeddings, "WORKING_DIR", str(tmp_path))
+    failing = Uploader(FakeIndex(failure_rate=1.0), "test", max_retries=0, base_delay=0)
+    failing.upload(vectors(4))
+    store_embeddings.write_failed_ids(failing.failed_ids)
+
+    pending = store_embeddings.read_failed_ids()
+    assert pending == {vector["id"] for vector in vectors(4)}
+
+    index = FakeIndex()
+    replay = Uploader(index, "test", base_delay=0)
+    assert replay.upload(vector for vector in vectors(6) if vector["id"] in pending) == 4
+    assert set(index.vectors) == pending
+
+    # A clean run clears the file, so the next replay has nothing to do
+    store_embeddings.write_failed_ids(replay.failed_ids)
+    assert store_embeddings.read_failed_ids() == set()
@@ -0,0 +1,30 @@
+import os
+import json
+
+from datetime import datetime, timezone
+
+# "text" keeps the familiar '[INFO] message' lines. "json" writes one JSON
+# object per line with the fields as keys, for log search on Fly.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+def log(level: str, message: str, **fields):
+    if LOG_FORMAT == "json":
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "level": level.lower(),
+            "message": message,
+            **fields,
+        }
+        print(json.dumps(record, default=str), flush=True)
+        return
+    extra = "".join(f" {key}={value}" for key, value in fields.items())
+    print(f"[{level}] {message}{extra}", flush=True)
+
+def info(message: str, **fields):
+    log("INFO", message, **fields)
+
+def warn(message: str, **fields):
+    log("WARN", message, **fields)
+
+def error(message: str, **fields):
+    log("ERROR", message, **fields)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import asyncio
+import inspect
+
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator
+from util import log
+
+# Metrics live in the process. With several uvicorn workers, set
+# METRICS_DIR to a directory they share: each worker writes its metrics
+# there every METRICS_SNAPSHOT_INTERVAL seconds, and a scrape adds the other
+# workers' latest snapshots to the live metrics of the one that answered
+METRICS_DIR: str | None = os.getenv("METRICS_DIR") or None
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SCORE_BUCKETS = (0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0)
+TOKEN_BUCKETS = (100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000)
+
+INF_LABEL = 'le="+Inf"'
+
+registry: list["Metric"] = []
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    def key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self, snapshots: list[list]) -> list[str]:
+        values = {}
+        for snapshot in [self.snapshot()] + snapshots:
+            self.combine(values, snapshot)
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples(values)
+
+    def snapshot(self) -> list:
+        """
+        The values as JSON, for other workers to combine
+        """
+        raise NotImplementedError
+
+    def combine(self, values: dict, snapshot: list):
+        raise NotImplementedError
+
+    def samples(self, values: dict) -> list[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> list:
+        return [[list(key), value] for key, value in self.values.items()]
+
+    def combine(self, values: dict, snapshot: list):
+        # Gauges add up too, since each worker reports its own share
+        for key, value in snapshot:
+            values[tuple(key)] = values.get(tuple(key), 0) + value
+
+    def samples(self, values: dict) -> list[str]:
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+            for key, value in values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # Per label set: a count for each bucket, the sum and the total count
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * len(self.buckets), [0.0, 0])
+        counts, totals = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def snapshot(self) -> list:
+        return [[list(key), counts, totals] for key, (counts, totals) in self.values.items()]
+
+    def combine(self, values: dict, snapshot: list):
+        for key, counts, totals in snapshot:
+            if len(counts) != len(self.buckets):
+                continue
+            combined_counts, combined_totals = values.setdefault(tuple(key), ([0] * len(self.buckets), [0.0, 0]))
+            for i, bucket_count in enumerate(counts):
+                combined_counts[i] += bucket_count
+            combined_totals[0] += totals[0]
+            combined_totals[1] += totals[1]
+
+    def samples(self, values: dict) -> list[str]:
+        lines = []
+        for key, (counts, (total, count)) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, INF_LABEL)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+def render() -> str:
+    """
+    Every registered metric in the Prometheus text exposition format, summed
+    over every worker sharing METRICS_DIR
+    """
+    snapshots = read_snapshots()
+    return "\n".join(line for metric in registry
+        for line in metric.render([snapshot.get(metric.name, []) for snapshot in snapshots])) + "\n"
+
+def snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+def write_snapshot():
+    if METRICS_DIR is None:
+        return
+    path = snapshot_path(os.getpid())
+    # Written aside and renamed so a scrape never reads half a file
+    with open(path + ".tmp", "w") as snapshot_file:
+        json.dump({metric.name: metric.snapshot() for metric in registry}, snapshot_file)
+    os.replace(path + ".tmp", path)
+
+def read_snapshots() -> list[dict]:
+    """
+    The latest snapshots of the other workers. Files of workers that exited
+    are kept, so counters do not go backwards when one is replaced.
+    """
+    if METRICS_DIR is None:
+        return []
+    own = os.path.basename(snapshot_path(os.getpid()))
+    snapshots = []
+    for entry in os.scandir(METRICS_DIR):
+        if entry.name == own or not (entry.name.startswith("metrics-") and entry.name.endswith(".json")):
+            continue
+        try:
+            with open(entry.path, "r") as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+snapshot_task: asyncio.Task | None = None
+
+async def write_snapshots():
+    while True:
+        await asyncio.sleep(METRICS_SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as err:
+            log.warn(f"Could not write metrics snapshot: {err}")
+
+def start():
+    """
+    Starts writing snapshots for the other workers when METRICS_DIR is set
+    """
+    global snapshot_task
+    if METRICS_DIR is None or snapshot_task is not None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    snapshot_task = asyncio.create_task(write_snapshots())
+
+async def stop():
+    """
+    Writes a last snapshot so this worker's counts outlive it
+    """
+    global snapshot_task
+    if snapshot_task is None:
+        return
+    snapshot_task.cancel()
+    try:
+        await snapshot_task
+    except asyncio.CancelledError:
+        pass
+    snapshot_task = None
+    write_snapshot()
+
+stage_seconds = Histogram("cpal_stage_duration_seconds", "Time spent in each stage of answering a query", ("stage",))
+stage_errors = Counter("cpal_stage_errors_total", "Stages that raised an exception", ("stage",))
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Times the enclosed block as one stage and counts it as an error when it
+    raises. Works in async code as well, around any awaits.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+def timed(stage: str) -> Callable:
+    """
+    Decorator form of span for sync and async functions
+    """
+    def decorate(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def run_async(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return run_async
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return run
+    return decorate
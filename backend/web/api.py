@@ -1,11 +1,18 @@
 import os
+import json
 
-from fastapi import APIRouter, Body
-from service import captcha, embedding, vectordb, events, llm
-from util import sanitize
+from typing import AsyncIterator
+from fastapi import APIRouter, Body, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from service import admission, captcha, embedding, events, evidence, lexical, llm, qa, startup
+from service.cache import semantic_cache
+from util import log, metrics
 
 router = APIRouter()
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @router.get("/livez")
 async def serv_api():
     return {
@@ -13,97 +20,126 @@ async def serv_api():
         "message":"all systems are functioning properly"
     }
 
+@router.get("/readyz")
+async def serv_ready():
+    """
+    Reports whether each dependency finished initializing. Unlike /livez,
+    answers 503 until the app can serve queries. The database is listed
+    but not required, since queries still work while it is down.
+    """
+    ready = startup.is_ready()
+    return JSONResponse(status_code=200 if ready else 503, content={
+        "status": "ok" if ready else "starting",
+        "dependencies": startup.readiness(),
+    })
+
+@router.get("/stats")
+async def serv_stats():
+    return {
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "embedding": embedding.stats(),
+        "event_writer": events.writer.stats(),
+        "captcha": captcha.stats(),
+        "retrieval": qa.stats(),
+        "lexical": lexical.stats(),
+        "evidence": evidence.stats(),
+        "llm": llm.stats(),
+        "admission": admission.stats(),
+    }
+
+@router.get("/metrics")
+async def serv_metrics():
+    """
+    Stage latencies, errors, cache hits, match scores and prompt sizes in
+    the Prometheus text format
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @router.get("/config")
 async def serv_config():
-    CAPTCHA_SITE_KEY = os.getenv("CAPTCHA_SITE_KEY") 
+    CAPTCHA_SITE_KEY = os.getenv("CAPTCHA_SITE_KEY")
     return {
         "captcha":CAPTCHA_SITE_KEY
     }
 
-@router.post("/query")
-async def process_query(query:str = Body(embed=True), captcha_token:str = Body(embed=True)):
-    try:
-        query = sanitize.sanitize_query(query)
-    except:
-        print(f"[WARN]: Query sanitization failed. Rejecting...")
-        return {"answer": "I am sorry. I am only designed to answer questions related to Canvas and its commonly integrated applications.", "sources":[]}
+def client_ip(request: Request) -> str | None:
+    return admission.client_ip(request.headers, request.client.host if request.client else None)
 
-    if not captcha.verify(captcha_token):
-        return {"answer": "I am sorry. An error occured...", "sources":[]}
+def rate_limited(request: Request) -> bool:
+    return not admission.rate_limiter.allow(client_ip(request) or "unknown")
 
+@router.post("/query")
+async def process_query(request: Request, query:str = Body(embed=True), captcha_token:str = Body(embed=True)):
+    # Rejections are answers rather than error statuses so the chat shows them
+    if rate_limited(request):
+        return {"answer": admission.RATE_LIMITED_ANSWER, "sources":[]}
     try:
-        print(f"[INFO] Querying '{query}'")
-        print(f"[INFO] Retrieving additional queries")
-        query_rewrite_prompt = str("You are a helpful assistant to Canvas Learning Management System users. " +
-            "Complete the empty V1, V2, & V3 below and respond ONLY in plaintext WITHOUT the 'V1' 'V2' & 'V3'" +
-            "QUESTION: How do I find my course? " +
-            "V1: How do I access the Canvas dashboard? " +
-            "V2: How do I log into Canvas? " +
-            "V3: How do I find all my Canvas courses? " +
-            f"QUESTION: {query}? " +
-            "V1: ___ ? " +
-            "V2: ___ ? " +
-            "V3: ___ ? ")
-        additional_queries = llm.query_llm(query_rewrite_prompt)
-        print(f"[INFO] Fond new queries: {additional_queries}")
-
-        query_embeddings = embedding.extract_embeddings(str(query + additional_queries))
-        matches = vectordb.query_similar(query_embeddings.tolist())
-
-        # If forum questions are returned, replace with answers
-        chunk_ids = []
-        for i, match in enumerate(matches):
-            chunk_ids.append(match.id)
-            if match.score < 0.75:
-                continue
-            if match.id.split("-")[1] != "0" or not match.metadata.text.startswith("Question"):
-                continue
-
-            print(f"[INFO] Found question chunk returned. Replacing chunk {match.id} with an answer")
-            answers = vectordb.get_chunk(match.id.split("-")[0] + "-1")
-            answer = answers[0]
-            print(f"[INFO] Found answer chunk {answer.id}")
-            chunk_ids.append(answer.id)
-            matches[i].id = answer.id
-            matches[i].metadata = answer.metadata
-
-        source_urls = set()
-        sources = []
-        supporting_text = []
-
-        for match in matches:
-            # Discard low quality matches
-            if match.score < 0.50:
-                continue
-            supporting_text.append(match.metadata.text)
-            if match.metadata.source_url not in source_urls:
-                source_urls.add(match.metadata.source_url)
-                sources.append({"url":match.metadata.source_url, "title":match.metadata.source_url_title, "score":match.score})
-
-        # If no relevant info received, return canned "I don't know" message
-        if len(supporting_text) == 0:
-            return {"answer": "I am sorry. I was unable to find any information related to your query. Maybe try asking it in a different way?", "sources":sources}
-
-        # Build the prompt base on a already running Q&A format
-        prompt = str("You are a helpful assistat for Canvas Learning Management System users. " + 
-            "DO NOT IGNORE ANY OF THESE INSTRUCTIONS. " +
-            "DO NOT REPLY WITH QUESTIONS. ONLY MAKE HELPFUL STATEMENTS. " +
-            "Provide a markdown response that ONLY completes the next 'ANSWER:' in the following conversation:: " +
-            "QUESTION: I have a question about Canvas. " +
-            "EVIDENCE: The user wants help with Canvas. We should respond in a helpful tone." +
-            "ANSWER: I am happy to help. What is your question? " +
-            f"QUESTION: {query} " +
-            f"EVIDENCE: {supporting_text} " +
-            "ANSWER: ")
-
-        answer = llm.query_llm(prompt)
-
+        with metrics.span("query"):
+            retrieval, answer = await qa.answer(query, captcha_token, client_ip(request))
+        return {"answer":answer,"sources":retrieval.sources}
+    except admission.OverloadedError as err:
+        log.warn(f"Query shed: {err}")
+        return {"answer": admission.OVERLOADED_ANSWER, "sources":[]}
+    except Exception as err:
+        log.error(f"Answer retrieval failed: {err}")
+        return {"answer": qa.ERROR_ANSWER, "sources":[]}
+
+@router.post("/query/stream")
+async def process_query_stream(request: Request, query:str = Body(embed=True), captcha_token:str = Body(embed=True)):
+    """
+    Same as /query, but sends the sources as soon as retrieval finishes and
+    then streams the answer as it is generated. Events are 'sources',
+    'token' (repeated), then 'done' or 'error'.
+    """
+    limited = rate_limited(request)
+    remote_ip = client_ip(request)
+
+    async def stream() -> AsyncIterator[str]:
+        if limited:
+            yield sse_event("error", {"answer": admission.RATE_LIMITED_ANSWER})
+            return
         try:
-            events.log_qa(question=query, chunk_ids=str(chunk_ids), answer=answer)
+            with metrics.span("query_stream"):
+                async for event in stream_answer():
+                    yield event
+        except admission.OverloadedError as err:
+            log.warn(f"Query shed: {err}")
+            yield sse_event("error", {"answer": admission.OVERLOADED_ANSWER})
+
+    async def stream_answer() -> AsyncIterator[str]:
+        try:
+            question, retrieval = await qa.retrieve(query, captcha_token, remote_ip)
+        except admission.OverloadedError:
+            raise
         except Exception as err:
-            print(f"[ERROR] Failed to log question and answer: {err}")
+            log.error(f"Answer retrieval failed: {err}")
+            yield sse_event("error", {"answer": qa.ERROR_ANSWER})
+            return
+
+        yield sse_event("sources", retrieval.sources)
+        if retrieval.prompt is None:
+            yield sse_event("token", {"text": retrieval.answer})
+            if retrieval.cached:
+                await qa.record(question, retrieval, retrieval.answer)
+            yield sse_event("done", {})
+            return
+
+        answer = []
+        try:
+            async for text in llm.stream_llm_async(retrieval.prompt):
+                answer.append(text)
+                yield sse_event("token", {"text": text})
+        except admission.OverloadedError:
+            raise
+        except Exception as err:
+            log.error(f"Answer streaming failed: {err}")
+            yield sse_event("error", {"answer": qa.ERROR_ANSWER})
+            return
 
-        return {"answer":answer,"sources":sources}
-    except Exception as err:
-        print(f"[ERROR]: Answer retrieval failed: {err}")
-        return {"answer": "I am sorry. An error occured. Please try again.", "sources":[]}
+        # Record before the final event so a client closing the connection
+        # on 'done' cannot cut the logging short
+        await qa.record(question, retrieval, "".join(answer))
+        yield sse_event("done", {})
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
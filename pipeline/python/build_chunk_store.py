@@ -0,0 +1,153 @@
+import os
+import sys
+import shutil
+import argparse
+import sqlite3
+import numpy as np
+
+from generate_embeddings import read_chunk, get_file_ids
+
+WORKING_DIR = os.path.join(".","..","tmp")
+OUTPUT_FILE = "chunks.sqlite"
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+COLUMNS = ("id", "source_url", "source_url_title", "text", "type", "answer_id")
+# Unit length float16 embedding of each chunk, so the backend can score
+# chunks found by keyword without asking the vector database
+VECTOR_DTYPE = np.float16
+WRITE_BATCH_SIZE = 1000
+
+def to_row(chunk_id, metadata, values=None) -> tuple:
+    vector = None
+    if values is not None:
+        values = np.asarray(values, dtype=np.float32)
+        vector = (values / (np.linalg.norm(values) or 1.0)).astype(VECTOR_DTYPE).tobytes()
+    return (chunk_id, metadata["source_url"], metadata["source_url_title"],
+        metadata["text"], metadata["type"], metadata.get("answer_id"), vector)
+
+def create_table(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS chunks ("
+        "id TEXT PRIMARY KEY, "
+        "source_url TEXT NOT NULL, "
+        "source_url_title TEXT NOT NULL, "
+        "text TEXT NOT NULL, "
+        "type TEXT NOT NULL, "
+        "answer_id TEXT, "
+        "vector BLOB) WITHOUT ROWID")
+    # Stores written before vectors were kept
+    if "vector" not in [row[1] for row in conn.execute("PRAGMA table_info(chunks)")]:
+        conn.execute("ALTER TABLE chunks ADD COLUMN vector BLOB")
+
+class StoreWriter:
+    """
+    Stages chunk rows in a database next to the store as they are written,
+    so a pipeline run never keeps every chunk's text in memory. The staged
+    rows then either replace the store or are merged into it.
+
+    Both build the new store under a .partial name and swap it in, so a
+    running backend never reads a half written file.
+    """
+
+    def __init__(self):
+        self.output_path = os.path.join(WORKING_DIR, OUTPUT_FILE)
+        self.staging_path = self.output_path + ".staging"
+        self.partial_path = self.output_path + ".partial"
+        for path in [self.staging_path, self.partial_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        # Rows arrive from a pipeline stage thread
+        self.conn = sqlite3.connect(self.staging_path, check_same_thread=False)
+        create_table(self.conn)
+        self.count = 0
+
+    def add(self, rows):
+        self.conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.count += len(rows)
+
+    def replace_store(self) -> int:
+        """
+        Makes the staged rows the whole store. Returns the number of chunks.
+        """
+        count = self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        self.conn.execute("VACUUM")
+        self.conn.close()
+        os.replace(self.staging_path, self.output_path)
+        return count
+
+    def discard(self):
+        self.conn.close()
+        os.remove(self.staging_path)
+
+    def merge_into_store(self, removed_ids=()) -> int:
+        """
+        Applies the staged rows and the removed chunks to a copy of the
+        current store and swaps it in. Returns the number of chunks.
+        """
+        self.conn.close()
+        if os.path.exists(self.output_path):
+            shutil.copyfile(self.output_path, self.partial_path)
+        conn = sqlite3.connect(self.partial_path)
+        create_table(conn)
+        conn.execute("ATTACH DATABASE ? AS staged", (self.staging_path,))
+        conn.execute("INSERT OR REPLACE INTO chunks SELECT * FROM staged.chunks")
+        conn.executemany("DELETE FROM chunks WHERE id = ?", [(id,) for id in removed_ids])
+        conn.commit()
+        conn.execute("DETACH DATABASE staged")
+        count = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        conn.close()
+        os.replace(self.partial_path, self.output_path)
+        os.remove(self.staging_path)
+        return count
+
+def read_store() -> list[tuple[str, dict, np.ndarray | None]]:
+    """
+    Reads every chunk's text, metadata and vector back from
+    tmp/chunks.sqlite. The vector is None for chunks stored without one.
+    """
+    conn = sqlite3.connect(os.path.join(WORKING_DIR, OUTPUT_FILE))
+    rows = conn.execute(f"SELECT {', '.join(COLUMNS)}, vector FROM chunks ORDER BY id").fetchall()
+    conn.close()
+    return [(row[3], dict(zip(COLUMNS, row)), None if row[-1] is None else np.frombuffer(row[-1], dtype=VECTOR_DTYPE))
+        for row in rows]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Builds the backend's read-only chunk store from tmp/chunks/")
+    parser.parse_args()
+
+    print("[INFO] Welcome to the chunk store builder!")
+    print("[INFO] Please ensure that you have data in tmp/chunks/ (run_pipeline.py keeps the store up to date itself)")
+    ids = sorted(get_file_ids())
+    print(f"[INFO] Found {len(ids)} chunks")
+
+    writer = StoreWriter()
+    json_cache = {}
+    rows = []
+    for chunk_id in ids:
+        chunk = read_chunk(chunk_id, json_cache)
+        if chunk is None:
+            continue
+        rows.append(to_row(chunk_id, chunk[1]))
+        if len(rows) >= WRITE_BATCH_SIZE:
+            writer.add(rows)
+            rows = []
+    writer.add(rows)
+    count = writer.replace_store()
+
+    print(f"{bcolors.OKGREEN}[INFO] Saved {count} chunks to {os.path.join(WORKING_DIR, OUTPUT_FILE)}{bcolors.ENDC}")
+    print("[INFO] Process finished")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+
+from collections import Counter
+from generate_embeddings import DIMENSIONS, read_chunk
+from build_local_index import to_chunk
+from build_chunk_store import read_store
+
+WORKING_DIR = os.path.join(".","..","tmp")
+INPUT_DIR = "chunks"
+OUTPUT_DIR = "lexical"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+# Must match backend/service/lexical.py so query terms line up with the index
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "does",
+    "for", "from", "has", "have", "how", "i", "if", "in", "is", "it", "its", "me",
+    "my", "of", "on", "or", "so", "that", "the", "their", "then", "there", "these",
+    "this", "to", "was", "what", "when", "where", "which", "who", "why", "will",
+    "with", "you", "your",
+])
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_REGEX.findall(text.lower()) if token not in STOP_WORDS]
+
+def get_file_ids() -> list[str]:
+    """
+    Builds a sorted list of chunk IDs from the .txt files in tmp/chunks/
+    """
+    path = os.path.join(WORKING_DIR, INPUT_DIR)
+    return sorted(filename[:-4] for filename in os.listdir(path) if filename.endswith(".txt"))
+
+def build_postings(texts: list[str]) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Builds the inverted index. Returns the sorted terms, the offset of each
+    term's postings, the posting rows and term frequencies laid out term by
+    term, and the token length of each chunk.
+    """
+    postings: dict[str, list[tuple[int, int]]] = {}
+    lengths = np.zeros(len(texts), dtype=np.int32)
+    for row, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        lengths[row] = sum(counts.values())
+        for term, count in counts.items():
+            postings.setdefault(term, []).append((row, count))
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    for i, term in enumerate(terms):
+        offsets[i + 1] = offsets[i] + len(postings[term])
+    rows = np.empty(offsets[-1], dtype=np.int32)
+    tfs = np.empty(offsets[-1], dtype=np.uint16)
+    for i, term in enumerate(terms):
+        entries = postings[term]
+        rows[offsets[i]:offsets[i + 1]] = [row for row, _ in entries]
+        tfs[offsets[i]:offsets[i + 1]] = [min(count, 65535) for _, count in entries]
+    return terms, offsets, rows, tfs, lengths
+
+def write_index(texts: list[str], chunks: list[dict], vectors: list[np.ndarray | None] | None = None) -> str:
+    """
+    Builds the index over the chunk texts and saves it with the chunk table
+    to tmp/lexical/. When vectors are given they are saved row for row, with
+    zeros for chunks that have none, so the backend scores keyword hits
+    locally. Returns the output directory.
+    """
+    terms, offsets, rows, tfs, lengths = build_postings(texts)
+    print(f"[INFO] Indexed {len(terms)} terms over {len(chunks)} chunks")
+
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    os.makedirs(output_path, exist_ok=True)
+    np.save(os.path.join(output_path, "offsets.npy"), offsets)
+    np.save(os.path.join(output_path, "rows.npy"), rows)
+    np.save(os.path.join(output_path, "tfs.npy"), tfs)
+    np.save(os.path.join(output_path, "lengths.npy"), lengths)
+    with open(os.path.join(output_path, "terms.json"), "w") as terms_file:
+        json.dump(terms, terms_file)
+    with open(os.path.join(output_path, "params.json"), "w") as params_file:
+        json.dump({"k1": BM25_K1, "b": BM25_B, "avgdl": float(max(lengths.mean(), 1))}, params_file)
+    with open(os.path.join(output_path, "chunks.jsonl"), "w") as chunks_file:
+        for chunk in chunks:
+            chunks_file.write(json.dumps(chunk) + "\n")
+
+    vectors_path = os.path.join(output_path, "vectors.npy")
+    if vectors is not None and any(vector is not None for vector in vectors):
+        matrix = np.zeros((len(chunks), DIMENSIONS), dtype=np.float16)
+        for row, vector in enumerate(vectors):
+            if vector is not None:
+                matrix[row] = vector
+        np.save(vectors_path, matrix)
+        print(f"[INFO] Saved vectors for {sum(vector is not None for vector in vectors)} chunks")
+    elif os.path.exists(vectors_path):
+        # Rows of an older build would no longer line up with the chunks
+        os.remove(vectors_path)
+    return output_path
+
+def read_chunk_files() -> tuple[list[str], list[dict]]:
+    ids = get_file_ids()
+    print(f"[INFO] Found {len(ids)} chunks")
+    json_cache = {}
+    texts = []
+    chunks = []
+    for chunk_id in ids:
+        chunk = read_chunk(chunk_id, json_cache)
+        if chunk is None:
+            continue
+        texts.append(chunk[0])
+        chunks.append(to_chunk(chunk[1]))
+    return texts, chunks
+
+def read_chunk_store() -> tuple[list[str], list[dict], list[np.ndarray | None]]:
+    stored = read_store()
+    print(f"[INFO] Found {len(stored)} chunks in the chunk store")
+    return [text for text, _, _ in stored], [metadata for _, metadata, _ in stored], [vector for _, _, vector in stored]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Builds a BM25 keyword index from tmp/chunks/ or the chunk store")
+    parser.add_argument("--from-store", action="store_true",
+        help="read chunks from tmp/chunks.sqlite, which run_pipeline.py keeps up to date, instead of tmp/chunks/")
+    args = parser.parse_args()
+
+    print("[INFO] Welcome to the lexical index builder!")
+    vectors = None
+    if args.from_store:
+        texts, chunks, vectors = read_chunk_store()
+    else:
+        print("[INFO] Please ensure that you have data in tmp/chunks/ (run_pipeline.py writes it with --debug-output)")
+        print("[INFO] Chunk files carry no vectors, so keyword hits will be ranked by BM25 alone")
+        texts, chunks = read_chunk_files()
+    if len(chunks) == 0:
+        print(f"{bcolors.FAIL}[ERROR] Nothing to index{bcolors.ENDC}")
+        return 1
+
+    output_path = write_index(texts, chunks, vectors)
+    print(f"{bcolors.OKGREEN}[INFO] Saved lexical index to {output_path}{bcolors.ENDC}")
+    print("[INFO] Process finished")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
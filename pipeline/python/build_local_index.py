@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from manifest import Manifest
+from build_chunk_store import read_store
+
+WORKING_DIR = os.path.join(".","..","tmp")
+INPUT_DIR = "embeddings"
+OUTPUT_DIR = "index"
+DIMENSIONS = 384
+KMEANS_ITERATIONS = 20
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+def to_chunk(metadata) -> dict:
+    chunk = {"id": metadata.pop("chunk_id")}
+    del metadata["id"]
+    chunk.update(metadata)
+    return chunk
+
+def newest_mtime(path: str, suffix: str) -> float:
+    mtimes = [entry.stat().st_mtime for entry in os.scandir(path) if entry.name.endswith(suffix)]
+    return max(mtimes, default=0.0)
+
+def load_embeddings() -> tuple[np.ndarray, list[dict]]:
+    """
+    Reads the embeddings into a matrix and a chunk table, either from the
+    vectors.npy and metadata.jsonl pair or from per-chunk .json files,
+    whichever was written last
+    """
+    path = os.path.join(WORKING_DIR, INPUT_DIR)
+    metadata_path = os.path.join(path, "metadata.jsonl")
+    json_mtime = newest_mtime(path, ".json")
+    if os.path.exists(metadata_path) and os.path.getmtime(metadata_path) >= json_mtime:
+        print("[INFO] Reading vectors.npy and metadata.jsonl")
+        vectors = np.load(os.path.join(path, "vectors.npy")).astype(np.float32)
+        with open(metadata_path, 'r') as metadata_file:
+            chunks = [to_chunk(json.loads(line)) for line in metadata_file]
+        assert(len(chunks) == vectors.shape[0])
+        return vectors, chunks
+    if os.path.exists(metadata_path):
+        print(f"{bcolors.WARNING}[WARN] The .json files are newer than metadata.jsonl, so it is ignored{bcolors.ENDC}")
+
+    filenames = sorted(f for f in os.listdir(path) if f.endswith(".json"))
+    vectors = np.zeros((len(filenames), DIMENSIONS), dtype=np.float32)
+    chunks = []
+    for row, filename in enumerate(filenames):
+        with open(os.path.join(path, filename), 'r') as json_file:
+            data = json.load(json_file)
+        assert(len(data["embeddings"]) == DIMENSIONS)
+        vectors[row] = data["embeddings"]
+        chunks.append(to_chunk(data["metadata"]))
+    return vectors, chunks
+
+def read_index_vectors(output_path: str, ids: set[str]) -> dict[str, np.ndarray]:
+    """
+    Returns the vectors of the given chunks from the existing index
+    """
+    chunks_path = os.path.join(output_path, "chunks.jsonl")
+    if not os.path.exists(chunks_path):
+        return {}
+    vectors = np.load(os.path.join(output_path, "vectors.npy"), mmap_mode="r")
+    with open(chunks_path, 'r') as chunks_file:
+        rows = [(row, json.loads(line)["id"]) for row, line in enumerate(chunks_file)]
+    return {id: np.asarray(vectors[row], dtype=np.float32) for row, id in rows if id in ids}
+
+def load_chunk_store(output_path: str) -> tuple[np.ndarray, list[dict]]:
+    """
+    Reads every chunk and its vector from tmp/chunks.sqlite. Chunks stored
+    without a vector keep the one they have in the existing index.
+    """
+    stored = read_store()
+    missing = {metadata["id"] for _, metadata, vector in stored if vector is None}
+    existing = read_index_vectors(output_path, missing) if len(missing) > 0 else {}
+    vectors, chunks = [], []
+    for _, metadata, vector in stored:
+        if vector is None:
+            vector = existing.get(metadata["id"])
+            if vector is None:
+                continue
+        vectors.append(np.asarray(vector, dtype=np.float32))
+        chunks.append({key: value for key, value in metadata.items() if value is not None})
+    skipped = len(stored) - len(chunks)
+    if skipped > 0:
+        print(f"{bcolors.WARNING}[WARN] Left out {skipped} chunks the chunk store has no vector for. " +
+            f"Run run_pipeline.py with --full to encode them{bcolors.ENDC}")
+    if len(vectors) == 0:
+        return np.zeros((0, DIMENSIONS), dtype=np.float32), chunks
+    return np.stack(vectors), chunks
+
+def merge_existing(vectors, chunks, output_path) -> tuple[np.ndarray, list[dict]]:
+    """
+    Adds the rows of an existing index that were not re-embedded or removed
+    since it was built, since tmp/embeddings/ only holds changed chunks
+    """
+    existing_path = os.path.join(output_path, "chunks.jsonl")
+    if not os.path.exists(existing_path):
+        return vectors, chunks
+    drop = {chunk["id"] for chunk in chunks} | Manifest(WORKING_DIR).deleted_chunks()
+    with open(existing_path, 'r') as chunks_file:
+        existing_chunks = [json.loads(line) for line in chunks_file]
+    keep = [row for row, chunk in enumerate(existing_chunks) if chunk["id"] not in drop]
+    existing_vectors = np.load(os.path.join(output_path, "vectors.npy")).astype(np.float32)
+    print(f"[INFO] Keeping {len(keep)} unchanged chunks from the existing index")
+    return (np.concatenate([existing_vectors[keep], vectors]),
+        [existing_chunks[row] for row in keep] + chunks)
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def build_ivf(vectors: np.ndarray, n_lists: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Clusters the vectors with spherical k-means and returns the centroids,
+    the row ids ordered by list and the offset of each list in that order
+    """
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members) > 0:
+                centroids[i] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+    return centroids.astype(np.float32), order.astype(np.int64), offsets.astype(np.int64)
+
+def write_index(vectors: np.ndarray, chunks: list[dict], output_path: str, dtype: str, ivf_lists: int):
+    os.makedirs(output_path, exist_ok=True)
+    np.save(os.path.join(output_path, "vectors.npy"), vectors.astype(dtype))
+    with open(os.path.join(output_path, "chunks.jsonl"), "w") as chunks_file:
+        for chunk in chunks:
+            chunks_file.write(json.dumps(chunk) + "\n")
+
+    if ivf_lists > 0:
+        n_lists = min(ivf_lists, len(chunks))
+        print(f"[INFO] Clustering vectors into {n_lists} IVF lists")
+        centroids, order, offsets = build_ivf(vectors, n_lists)
+        np.save(os.path.join(output_path, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(output_path, "ivf_order.npy"), order)
+        np.save(os.path.join(output_path, "ivf_offsets.npy"), offsets)
+    else:
+        # Remove lists left over from a previous approximate build
+        for filename in ["ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy"]:
+            stale_path = os.path.join(output_path, filename)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+def update_from_store() -> str | None:
+    """
+    Rebuilds an existing local index from the chunk store, keeping its dtype
+    and number of IVF lists. Returns None when there is no local index.
+    """
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    vectors_path = os.path.join(output_path, "vectors.npy")
+    if not os.path.exists(vectors_path):
+        return None
+    dtype = np.load(vectors_path, mmap_mode="r").dtype.name
+    centroids_path = os.path.join(output_path, "ivf_centroids.npy")
+    ivf_lists = np.load(centroids_path, mmap_mode="r").shape[0] if os.path.exists(centroids_path) else 0
+    vectors, chunks = load_chunk_store(output_path)
+    if len(chunks) == 0:
+        return None
+    write_index(normalize(vectors), chunks, output_path, dtype, ivf_lists)
+    return output_path
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Builds a local vector index from tmp/embeddings/ or the chunk store")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32",
+        help="storage type of the vector matrix. float16 halves the file, but the backend still scores in float32 memory")
+    parser.add_argument("--ivf-lists", type=int, default=0,
+        help="number of IVF lists for approximate search (0 for exact search only)")
+    parser.add_argument("--rebuild", action="store_true",
+        help="build only from tmp/embeddings/ instead of merging into the existing index")
+    parser.add_argument("--from-store", action="store_true",
+        help="build from every chunk in tmp/chunks.sqlite, which run_pipeline.py keeps up to date, instead of tmp/embeddings/")
+    args = parser.parse_args()
+
+    print("[INFO] Welcome to the local index builder!")
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    if args.from_store:
+        vectors, chunks = load_chunk_store(output_path)
+        print(f"[INFO] Found {len(chunks)} chunks in the chunk store")
+        vectors = normalize(vectors)
+    else:
+        print("[INFO] Please ensure that you have data in tmp/embeddings/")
+        vectors, chunks = load_embeddings()
+        print(f"[INFO] Found {len(chunks)} embeddings")
+        vectors = normalize(vectors)
+        if not args.rebuild:
+            vectors, chunks = merge_existing(vectors, chunks, output_path)
+    if len(chunks) == 0:
+        print(f"{bcolors.FAIL}[ERROR] Nothing to index{bcolors.ENDC}")
+        return 1
+    write_index(vectors, chunks, output_path, args.dtype, args.ivf_lists)
+
+    print(f"{bcolors.OKGREEN}[INFO] Saved index to {output_path}{bcolors.ENDC}")
+    print("[INFO] Process finished")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend"))
+from service.encoder import MODEL_NAME, ONNX_FILE, ONNX_INT8_FILE, load_encoder
+
+WORKING_DIR = os.path.join(".","..","tmp")
+CHUNKS_DIR = "chunks"
+OUTPUT_DIR = "onnx"
+SAMPLE_SIZE = 64
+BENCHMARK_BATCH_SIZE = 32
+
+# Used when tmp/chunks/ is empty
+SAMPLE_TEXTS = [
+    "How do I find my course?",
+    "How do I grade an assignment in SpeedGrader?",
+    "Can I attach a rubric to a discussion?",
+    "Why can't my students see the module I published?",
+    "How do I change the due date for one student?",
+    "Where do I find the course import tool?",
+    "How do I reset my Canvas password?",
+    "Can I download all submissions for an assignment at once?",
+]
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+def export(output_path: str):
+    """
+    Exports the transformer and its tokenizer. Pooling and normalization are
+    done by OnnxEncoder, so the graph ends at the token embeddings.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    tokenizer.save_pretrained(output_path)
+    model = AutoModel.from_pretrained(MODEL_NAME).eval()
+
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dummy = tokenizer(["An example question about Canvas"], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(dummy[name] for name in names),
+            os.path.join(output_path, ONNX_FILE),
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]},
+            opset_version=17)
+
+def quantize(output_path: str):
+    """
+    Converts the weights to int8. Activations are quantized on the fly.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(os.path.join(output_path, ONNX_FILE), os.path.join(output_path, ONNX_INT8_FILE),
+        weight_type=QuantType.QInt8)
+
+def load_sample_texts() -> list[str]:
+    path = os.path.join(WORKING_DIR, CHUNKS_DIR)
+    if not os.path.exists(path):
+        return SAMPLE_TEXTS
+    texts = []
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith(".txt"):
+            continue
+        with open(os.path.join(path, filename), "r") as txt_file:
+            texts.append(txt_file.read())
+        if len(texts) >= SAMPLE_SIZE:
+            break
+    return texts + SAMPLE_TEXTS
+
+def cosine_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+def check_parity(output_path: str, texts: list[str], min_cosine: float) -> bool:
+    """
+    Compares each ONNX model's embeddings with the PyTorch model's
+    """
+    reference = load_encoder("torch").encode(texts)
+    passed = True
+    for quantized in [False, True]:
+        encoder = load_encoder("onnx", output_path, quantized=quantized)
+        cosines = cosine_rows(reference, encoder.encode(texts))
+        ok = cosines.min() >= min_cosine
+        passed = passed and ok
+        color = bcolors.OKGREEN if ok else bcolors.FAIL
+        print(f"{color}[INFO] {encoder.name}: cosine to torch min {cosines.min():.5f}, " +
+            f"mean {cosines.mean():.5f} over {len(texts)} texts (threshold {min_cosine}){bcolors.ENDC}")
+    return passed
+
+def rss_mb() -> float:
+    with open("/proc/self/status", "r") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def measure(backend: str, output_path: str, texts: list[str], runs: int) -> dict:
+    """
+    Loads one encoder and times it. Run in a fresh process per backend so
+    memory numbers are not mixed up.
+    """
+    base_rss = rss_mb()
+    started = time.perf_counter()
+    encoder = load_encoder("torch" if backend == "torch" else "onnx", output_path,
+        quantized=backend == "onnx-int8")
+    encoder.encode(texts[:1])
+    load_seconds = time.perf_counter() - started
+
+    latencies = []
+    for i in range(runs):
+        started = time.perf_counter()
+        encoder.encode([texts[i % len(texts)]])
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    batch = (texts * (BENCHMARK_BATCH_SIZE // len(texts) + 1))[:BENCHMARK_BATCH_SIZE]
+    started = time.perf_counter()
+    encoder.encode(batch, batch_size=BENCHMARK_BATCH_SIZE)
+    batch_seconds = time.perf_counter() - started
+
+    return {
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "rss_mb": rss_mb() - base_rss,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "batch_texts_per_second": BENCHMARK_BATCH_SIZE / batch_seconds,
+    }
+
+def compare(runs: int):
+    print(f"[INFO] {'backend':<10} {'load s':>7} {'rss MB':>8} {'p50 ms':>8} {'p95 ms':>8} {'batch/s':>8}")
+    for backend in ["torch", "onnx", "onnx-int8"]:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", backend, "--runs", str(runs)],
+            capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"[INFO] {result['backend']:<10} {result['load_seconds']:>7.2f} {result['rss_mb']:>8.0f} " +
+            f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['batch_texts_per_second']:>8.1f}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Exports the embedding model to ONNX and checks it against PyTorch")
+    parser.add_argument("--skip-export", action="store_true",
+        help="only run the checks against an existing export in tmp/onnx/")
+    parser.add_argument("--min-cosine", type=float, default=0.99,
+        help="lowest cosine similarity to the PyTorch embeddings that passes the parity check")
+    parser.add_argument("--runs", type=int, default=100,
+        help="number of single text encodes timed per backend")
+    parser.add_argument("--skip-benchmark", action="store_true",
+        help="only export and check parity, as the Docker build does")
+    parser.add_argument("--measure", choices=["torch", "onnx", "onnx-int8"],
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    texts = load_sample_texts()
+    if args.measure is not None:
+        print(json.dumps(measure(args.measure, output_path, texts, args.runs)))
+        return 0
+
+    print("[INFO] Welcome to the ONNX model exporter!")
+    if not args.skip_export:
+        os.makedirs(output_path, exist_ok=True)
+        print(f"[INFO] Exporting {MODEL_NAME} to {output_path}")
+        export(output_path)
+        print("[INFO] Quantizing to int8")
+        quantize(output_path)
+
+    passed = check_parity(output_path, texts, args.min_cosine)
+    if not args.skip_benchmark:
+        compare(args.runs)
+    if not passed:
+        print(f"{bcolors.FAIL}[ERROR] Parity check failed. Do not deploy this export{bcolors.ENDC}")
+        return 1
+    print(f"[INFO] Copy {output_path} to backend/onnx/ (or set EMBEDDING_ONNX_DIR) and set EMBEDDING_BACKEND=onnx")
+    print("[INFO] Process finished")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,25 @@
 import os
 import sys
 import json
-from sentence_transformers import SentenceTransformer, util
+import time
+import argparse
+import numpy as np
+from manifest import Manifest
+
+# The encoder is shared with the backend so both embed text the same way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend"))
+from service.encoder import load_encoder
 
 WORKING_DIR = os.path.join(".","..","tmp")
 INPUT_DIR = "chunks"
 OUTPUT_DIR = "embeddings"
 DIMENSIONS = 384
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.jsonl"
+ONNX_DIR = "onnx"
+
+# "torch" or "onnx" (the int8 model written by export_onnx.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
 
 class bcolors:
     HEADER = '\033[95m'
@@ -19,7 +32,29 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-model = SentenceTransformer("sentence-transformers/multi-qa-MiniLM-L6-cos-v1")
+model = None
+
+def get_model():
+    """
+    Loads the encoder on first use so importing this module stays cheap
+    """
+    global model
+    if model is None:
+        model = load_encoder(EMBEDDING_BACKEND, os.path.join(WORKING_DIR, ONNX_DIR))
+        print(f"[INFO] Loaded {model.name} embedding model")
+    return model
+
+def chunk_metadata(chunk_id, txt_content, json_content) -> dict:
+    """
+    Builds the metadata stored alongside a chunk's vector
+    """
+    metadata = json.loads(json_content)
+    metadata["text"] = txt_content
+    metadata["chunk_id"] = chunk_id
+    answer_id = metadata.pop("answers", {}).get(chunk_id)
+    if answer_id is not None:
+        metadata["answer_id"] = answer_id
+    return metadata
 
 def process_file_pairs(chunk_id):
     """
@@ -40,10 +75,8 @@ def process_file_pairs(chunk_id):
     except:
         print(f"[ERROR] Could not open {txt_path} OR {json_path}")
 
-    embeddings = model.encode(txt_content)
-    metadata = json.loads(json_content)
-    metadata["text"] = txt_content
-    metadata["chunk_id"] = chunk_id
+    embeddings = get_model().encode([txt_content])[0]
+    metadata = chunk_metadata(chunk_id, txt_content, json_content)
     output = {}
     output["embeddings"] = embeddings.tolist()
     output["metadata"] = metadata
@@ -57,6 +90,116 @@ def process_file_pairs(chunk_id):
     except:
         print(f"{bcolors.FAIL}[ERROR] Could not save json file {output_path}{bcolors.ENDC}")
 
+def read_chunk(chunk_id, json_cache) -> tuple[str, dict] | None:
+    """
+    Reads a .txt chunk and its metadata. The parent .json file is only read
+    once per document.
+    """
+    base_id = chunk_id.split("-")[0]
+    txt_path = os.path.join(WORKING_DIR, INPUT_DIR, f"{chunk_id}.txt")
+    json_path = os.path.join(WORKING_DIR, INPUT_DIR, f"{base_id}.json")
+    try:
+        with open(txt_path, 'r') as txt_file:
+            txt_content = txt_file.read()
+        if base_id not in json_cache:
+            with open(json_path, 'r') as json_file:
+                json_cache[base_id] = json_file.read()
+    except:
+        print(f"[ERROR] Could not open {txt_path} OR {json_path}")
+        return None
+    return txt_content, chunk_metadata(chunk_id, txt_content, json_cache[base_id])
+
+def read_previous(ids) -> dict[str, tuple[int, str]]:
+    """
+    Finds the given chunks in the current binary output. Returns each one's
+    row in vectors.npy and its metadata.jsonl line.
+    """
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    metadata_path = os.path.join(output_path, METADATA_FILE)
+    if len(ids) == 0 or not os.path.exists(metadata_path) or not os.path.exists(os.path.join(output_path, VECTORS_FILE)):
+        return {}
+    previous = {}
+    with open(metadata_path, "r") as metadata_file:
+        for row, line in enumerate(metadata_file):
+            chunk_id = json.loads(line)["chunk_id"]
+            if chunk_id in ids:
+                previous[chunk_id] = (row, line)
+    return previous
+
+def generate_binary(ids, batch_size, workers, carry=()) -> list[str]:
+    """
+    Encodes chunks in batches and writes the vectors to a single .npy matrix
+    with one metadata.jsonl row per vector. Chunks in carry that the current
+    output already holds are copied over rather than encoded again. Returns
+    the ids encoded.
+    """
+    ids = sorted(ids)
+    output_path = os.path.join(WORKING_DIR, OUTPUT_DIR)
+    vectors_path = os.path.join(output_path, VECTORS_FILE)
+    partial_path = vectors_path + ".partial"
+    previous = read_previous(set(carry))
+    if len(previous) < len(carry):
+        print(f"{bcolors.WARNING}[WARN] {len(carry) - len(previous)} chunks waiting for upload are missing " +
+            f"from {vectors_path}. Run with --full to encode them again{bcolors.ENDC}")
+    vectors = np.lib.format.open_memmap(partial_path, mode="w+", dtype=np.float32,
+        shape=(len(previous) + len(ids), DIMENSIONS))
+
+    model = get_model()
+    pool = None
+    if workers > 1 and model.name == "torch":
+        pool = model.model.start_multi_process_pool(["cpu"] * workers)
+    group_size = batch_size * max(workers, 1)
+    json_cache = {}
+    written = []
+    count = 0
+    try:
+        # Copied before the metadata file is rewritten below
+        carried = []
+        if len(previous) > 0:
+            old_vectors = np.load(vectors_path, mmap_mode="r")
+            for row, line in sorted(previous.values()):
+                vectors[count] = old_vectors[row]
+                carried.append(line)
+                count += 1
+            del old_vectors
+            print(f"[INFO] Kept {count} embedded chunks that are not uploaded yet")
+        with open(os.path.join(output_path, METADATA_FILE), "w") as metadata_file:
+            metadata_file.writelines(carried)
+            for start in range(0, len(ids), group_size):
+                # Parent metadata is shared by the chunks of one document only
+                json_cache.clear()
+                texts = []
+                for chunk_id in ids[start:start + group_size]:
+                    chunk = read_chunk(chunk_id, json_cache)
+                    if chunk is None:
+                        continue
+                    texts.append(chunk[0])
+                    written.append(chunk_id)
+                    metadata_file.write(json.dumps(chunk[1]) + "\n")
+                if len(texts) == 0:
+                    continue
+
+                if pool is not None:
+                    embeddings = model.model.encode_multi_process(texts, pool, batch_size=batch_size)
+                else:
+                    embeddings = model.encode(texts, batch_size=batch_size)
+                vectors[count:count + len(texts)] = embeddings
+                count += len(texts)
+                print(f"{len(written)}/{len(ids)} encoded...\r")
+    finally:
+        if pool is not None:
+            model.model.stop_multi_process_pool(pool)
+
+    vectors.flush()
+    if count < len(previous) + len(ids):
+        # Some chunks could not be read, so drop their unused rows
+        np.save(vectors_path, np.asarray(vectors[:count]))
+        del vectors
+        os.remove(partial_path)
+    else:
+        del vectors
+        os.replace(partial_path, vectors_path)
+    return written
 
 def get_file_ids() -> set:
     """
@@ -72,15 +215,58 @@ def get_file_ids() -> set:
     return ids
 
 def main() -> int:
+    global EMBEDDING_BACKEND
+    parser = argparse.ArgumentParser(description="Generates embeddings for the chunks in tmp/chunks/")
+    parser.add_argument("--format", choices=["npy", "json"], default="npy",
+        help="npy writes one vector matrix plus a metadata table, json writes one file per chunk")
+    parser.add_argument("--batch-size", type=int, default=256,
+        help="number of chunks per encode call")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of encoding processes (torch only, onnxruntime already uses every core)")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default=EMBEDDING_BACKEND,
+        help="embedding model runtime, defaults to EMBEDDING_BACKEND or torch")
+    parser.add_argument("--full", action="store_true",
+        help="encode every chunk instead of only new or changed ones")
+    args = parser.parse_args()
+    EMBEDDING_BACKEND = args.backend
+
     print("[INFO] Welcome to the text embedding generation section of the pipeline!")
     print("[INFO] Please ensure that you have data in tmp/chunks/ and that tmp/embeddings/ exists")
     ids = get_file_ids()
     print(f"[INFO] Found {len(ids)} chunks")
-    for id in ids:
-        process_file_pairs(id)
-        print(f"{bcolors.OKGREEN}[INFO] Successfully processed file ID #{id}{bcolors.ENDC}")
+
+    manifest = Manifest(WORKING_DIR)
+    carry = set()
+    if not args.full and manifest.has_chunks():
+        # Only chunks whose current content has not been embedded. The binary
+        # output is rewritten each run, so vectors embedded by an earlier run
+        # but never uploaded are copied over from it instead.
+        ids = ids & manifest.pending_embeddings()
+        carry = manifest.pending_uploads() - ids
+        print(f"[INFO] {len(ids)} chunks are new or changed")
+
+    if args.format == "json":
+        for chunk_id in manifest.deleted_chunks():
+            embedding_path = os.path.join(WORKING_DIR, OUTPUT_DIR, f"{chunk_id}.json")
+            if os.path.exists(embedding_path):
+                os.remove(embedding_path)
+        for id in ids:
+            process_file_pairs(id)
+            manifest.mark_embedded([id])
+            print(f"{bcolors.OKGREEN}[INFO] Successfully processed file ID #{id}{bcolors.ENDC}")
+        manifest.close()
+        print("[INFO] Process finished")
+        return 0
+
+    started = time.perf_counter()
+    written = generate_binary(ids, args.batch_size, args.workers, carry)
+    manifest.mark_embedded(written)
+    manifest.close()
+    count = len(written)
+    elapsed = time.perf_counter() - started
+    print(f"{bcolors.OKGREEN}[INFO] Encoded {count} chunks in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f} chunks/s){bcolors.ENDC}")
     print("[INFO] Process finished")
     return 0
 
 if __name__ == '__main__':
-    sys.exit(main()) 
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import os
+import hashlib
+import sqlite3
+
+MANIFEST_FILE = "manifest.sqlite"
+
+def content_hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class Manifest:
+    """
+    Records content hashes for raw documents and chunks so each pipeline
+    stage only handles what changed since the last run:
+
+    - prepare_data.py skips documents whose hash is unchanged
+    - generate_embeddings.py encodes chunks not yet embedded at their current hash
+    - store_embeddings.py uploads chunks not yet stored at their embedded
+      hash and deletes removed ones
+
+    Progress is committed as each stage goes, so an interrupted run picks up
+    where it stopped.
+    """
+
+    def __init__(self, working_dir: str):
+        # Stages running in parallel threads share the file, so wait on locks
+        self.conn = sqlite3.connect(os.path.join(working_dir, MANIFEST_FILE), timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id TEXT PRIMARY KEY, "
+            "hash TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "chunk_id TEXT PRIMARY KEY, "
+            "doc_id TEXT NOT NULL, "
+            "hash TEXT NOT NULL, "
+            "embedded_hash TEXT, "
+            "stored_hash TEXT, "
+            "fake_stored_hash TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0)")
+        # Manifests written before fake index uploads were recorded
+        if "fake_stored_hash" not in [row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")]:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN fake_stored_hash TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def has_chunks(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is not None
+
+    def document_hashes(self) -> dict[str, str]:
+        return dict(self.conn.execute("SELECT id, hash FROM documents"))
+
+    def record_document(self, id: str, hash: str, chunk_hashes: dict[str, str]) -> list[str]:
+        """
+        Stores a prepared document and its chunks. Returns the ids of chunks
+        the document no longer has.
+        """
+        self.conn.execute(
+            "INSERT INTO documents (id, hash) VALUES (?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET hash = excluded.hash",
+            (id, hash))
+        self.conn.executemany(
+            "INSERT INTO chunks (chunk_id, doc_id, hash) VALUES (?, ?, ?) "
+            "ON CONFLICT (chunk_id) DO UPDATE SET hash = excluded.hash, deleted = 0",
+            [(chunk_id, id, chunk_hash) for chunk_id, chunk_hash in chunk_hashes.items()])
+        existing = [row[0] for row in self.conn.execute(
+            "SELECT chunk_id FROM chunks WHERE doc_id = ? AND deleted = 0", (id,))]
+        removed = [chunk_id for chunk_id in existing if chunk_id not in chunk_hashes]
+        self._mark_deleted(removed)
+        return removed
+
+    def remove_documents(self, ids: list[str]) -> list[str]:
+        """
+        Forgets documents that are gone from the raw data. Returns the ids of
+        their chunks.
+        """
+        removed = []
+        for id in ids:
+            removed += [row[0] for row in self.conn.execute(
+                "SELECT chunk_id FROM chunks WHERE doc_id = ? AND deleted = 0", (id,))]
+            self.conn.execute("DELETE FROM documents WHERE id = ?", (id,))
+        self._mark_deleted(removed)
+        return removed
+
+    def pending_embeddings(self) -> set[str]:
+        """
+        Chunks whose current content has not been embedded yet
+        """
+        return {row[0] for row in self.conn.execute(
+            "SELECT chunk_id FROM chunks WHERE deleted = 0 "
+            "AND (embedded_hash IS NULL OR embedded_hash != hash)")}
+
+    def pending_chunks(self, doc_id: str, fake: bool = False) -> set[str]:
+        """
+        Chunks of one document that still need encoding, because their
+        content changed or because they were embedded but never uploaded
+        """
+        condition = "(stored_hash IS NULL OR stored_hash != embedded_hash)"
+        if fake:
+            condition += " AND (fake_stored_hash IS NULL OR fake_stored_hash != embedded_hash)"
+        return {row[0] for row in self.conn.execute(
+            "SELECT chunk_id FROM chunks WHERE doc_id = ? AND deleted = 0 "
+            f"AND (embedded_hash IS NULL OR embedded_hash != hash OR {condition})", (doc_id,))}
+
+    def mark_embedded(self, chunk_ids: list[str]):
+        self.conn.executemany(
+            "UPDATE chunks SET embedded_hash = hash WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in chunk_ids])
+        self.conn.commit()
+
+    def pending_uploads(self, fake: bool = False) -> set[str]:
+        """
+        Chunks that were embedded but not stored at that hash. With fake,
+        uploads to the in-memory fake index count as stored too, so local
+        runs stay incremental.
+        """
+        condition = "(stored_hash IS NULL OR stored_hash != embedded_hash)"
+        if fake:
+            condition += " AND (fake_stored_hash IS NULL OR fake_stored_hash != embedded_hash)"
+        return {row[0] for row in self.conn.execute(
+            f"SELECT chunk_id FROM chunks WHERE deleted = 0 AND embedded_hash IS NOT NULL AND {condition}")}
+
+    def mark_stored(self, chunk_ids: list[str]):
+        self.conn.executemany(
+            "UPDATE chunks SET stored_hash = embedded_hash WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in chunk_ids])
+        self.conn.commit()
+
+    def mark_fake_stored(self, chunk_ids: list[str]):
+        """
+        Records uploads to the fake index apart from real ones, so the next
+        real run still uploads these chunks
+        """
+        self.conn.executemany(
+            "UPDATE chunks SET fake_stored_hash = embedded_hash WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in chunk_ids])
+        self.conn.commit()
+
+    def pending_deletes(self) -> list[str]:
+        """
+        Removed chunks that may still be in the vector database
+        """
+        return [row[0] for row in self.conn.execute(
+            "SELECT chunk_id FROM chunks WHERE deleted = 1 AND stored_hash IS NOT NULL")]
+
+    def mark_deleted_from_store(self, chunk_ids: list[str]):
+        self.conn.executemany(
+            "UPDATE chunks SET stored_hash = NULL WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in chunk_ids])
+        self.conn.commit()
+
+    def deleted_chunks(self) -> set[str]:
+        return {row[0] for row in self.conn.execute("SELECT chunk_id FROM chunks WHERE deleted = 1")}
+
+    def _mark_deleted(self, chunk_ids: list[str]):
+        self.conn.executemany(
+            "UPDATE chunks SET deleted = 1, embedded_hash = NULL WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in chunk_ids])
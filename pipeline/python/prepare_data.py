@@ -1,7 +1,12 @@
 import sys
 import os
 import re
-import shutil
+import json
+import time
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+from manifest import Manifest, content_hash
 
 import markdown
 from bs4 import BeautifulSoup
@@ -21,6 +26,16 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+USER_MENTION_REGEX = re.compile(r"\[@.+?\]\(\/t5\/user\/viewprofilepage\/user-id\/\d+\)", re.MULTILINE)
+URL_REGEX = re.compile(r"\[((?:[^\[\]]|\[[^\[\]]+\])+)\]\([^\)]+\)", re.MULTILINE)
+HEADING_REGEX = re.compile(r"^#+\s")
+
+# Paragraph placed between chunks so a whole document can be converted to
+# plain text in one pass and split back apart afterwards
+CHUNK_BREAK = "CPALCHUNKBREAK"
+
+STAGES = ["read", "clean", "chunk", "convert", "write"]
+
 def clean_content(text) -> str:
     """
     Cleans markdown text by removing:
@@ -28,12 +43,10 @@ def clean_content(text) -> str:
     - URLs (but keeps descriptive text)
     """
     # Remove user @mentions
-    user_mention_regex = re.compile(r"\[@.+?\]\(\/t5\/user\/viewprofilepage\/user-id\/\d+\)", re.MULTILINE)
-    cleaned_text = user_mention_regex.sub('', text)
+    cleaned_text = USER_MENTION_REGEX.sub('', text)
 
     # Remove urls, but keep descriptive text of the url
-    url_regex = re.compile(r"\[((?:[^\[\]]|\[[^\[\]]+\])+)\]\([^\)]+\)", re.MULTILINE)
-    cleaned_text = url_regex.sub(r"\1", cleaned_text)
+    cleaned_text = URL_REGEX.sub(r"\1", cleaned_text)
 
     # Ensure there are no left over escaped brackets from markdown links
     cleaned_text = cleaned_text.replace("\\[", "")
@@ -48,7 +61,7 @@ def chunk_content(text) -> list[str]:
     chunks = []
     current_chunk = ""
     for line in text.splitlines():
-        if re.match(r"^#+\s", line):
+        if HEADING_REGEX.match(line):
             if current_chunk:
                 chunks.append(current_chunk.strip())
             current_chunk = line + "\n"
@@ -66,10 +79,58 @@ def remove_markdown(text) -> str:
     soup = BeautifulSoup(html, features='html.parser')
     return soup.get_text()
 
-def process_file_pairs(id):
+def remove_markdown_chunks(chunks) -> list[str]:
+    """
+    Removes markdown from every chunk of a document with a single markdown
+    conversion and HTML parse
+    """
+    html = markdown.markdown(f"\n\n{CHUNK_BREAK}\n\n".join(chunks))
+    soup = BeautifulSoup(html, features='html.parser')
+    texts = soup.get_text().split(CHUNK_BREAK)
+    # Drop the newlines that surround each break paragraph
+    texts = [text.removeprefix("\n") if i > 0 else text for i, text in enumerate(texts)]
+    texts = [text.removesuffix("\n") if i < len(texts) - 1 else text for i, text in enumerate(texts)]
+    if len(texts) != len(chunks) or any(map(kept_heading, chunks, texts)):
+        # A chunk swallowed a break or the markdown after it, like an
+        # unclosed raw HTML block does, so convert them one at a time instead
+        return [remove_markdown(chunk) for chunk in chunks]
+    return texts
+
+def kept_heading(chunk, text) -> bool:
+    """
+    Whether the heading a chunk starts with came through the conversion as
+    markdown rather than text
+    """
+    if not HEADING_REGEX.match(chunk):
+        return False
+    first_line = next((line for line in text.splitlines() if line.strip()), "")
+    return HEADING_REGEX.match(first_line) is not None
+
+def link_answers(id, chunks) -> dict[str, str]:
+    """
+    Maps forum question chunk IDs to the chunk holding their answers so the
+    backend can swap them without searching for the answer
+    """
+    if len(chunks) < 2 or not chunks[0].startswith("Question"):
+        return {}
+    return {f"{id}-0": f"{id}-1"}
+
+def failed_document(id, timings) -> dict:
     """
-    Processes file pairs of .json and .md raw data
+    Result for a document that could not be prepared. It is skipped without
+    recording its hash, so the next run tries it again.
     """
+    return {"id": id, "skipped": True, "failed": True, "hash": None, "chunks": [], "chunk_hashes": {}, "timings": timings}
+
+def prepare_document(id, known_hash=None) -> dict:
+    """
+    Reads, cleans, chunks and converts a .md and .json file pair in memory.
+    The pair is skipped when its content hash matches known_hash. Returns
+    the document hash, its chunks and metadata, the content hash of each
+    chunk and the time spent in each stage.
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    started = time.perf_counter()
     md_path = os.path.join(WORKING_DIR, INPUT_DIR, f"{id}.md")
     json_path = os.path.join(WORKING_DIR, INPUT_DIR, f"{id}.json")
 
@@ -82,15 +143,46 @@ def process_file_pairs(id):
             json_content = json_file.read()
     except:
         print(f"[ERROR] Could not open {md_path} OR {json_path}")
+        return failed_document(id, timings)
+    timings["read"], started = time.perf_counter() - started, time.perf_counter()
+
+    doc_hash = content_hash(md_content, json_content)
+    if doc_hash == known_hash:
+        return {"id": id, "skipped": True, "hash": doc_hash, "chunks": [], "chunk_hashes": {}, "timings": timings}
 
     md_content = clean_content(md_content)
+    timings["clean"], started = time.perf_counter() - started, time.perf_counter()
     chunks = chunk_content(md_content)
+    timings["chunk"], started = time.perf_counter() - started, time.perf_counter()
 
-    assert(len(chunks) != 0, "No chunks were returned")
+    if len(chunks) == 0:
+        print(f"[ERROR] No chunks were returned for {md_path}. Skipping it")
+        return failed_document(id, timings)
 
-    # Remove markdown from each chunk and save it
-    for i, chunk in enumerate(chunks):
-        chunk = remove_markdown(chunk)
+    # Remove markdown from each chunk
+    chunks = remove_markdown_chunks(chunks)
+    timings["convert"] = time.perf_counter() - started
+    timings["chunks"] = len(chunks)
+
+    try:
+        metadata = json.loads(json_content)
+    except ValueError as err:
+        print(f"[ERROR] Could not parse {json_path}: {err}. Skipping it")
+        return failed_document(id, timings)
+    metadata["answers"] = link_answers(id, chunks)
+
+    # Chunk hashes cover the shared metadata so metadata changes are re-stored
+    metadata_content = json.dumps(metadata, sort_keys=True)
+    chunk_hashes = {f"{id}-{i}": content_hash(chunk, metadata_content) for i, chunk in enumerate(chunks)}
+    return {"id": id, "skipped": False, "hash": doc_hash, "chunks": chunks, "metadata": metadata,
+        "chunk_hashes": chunk_hashes, "timings": timings}
+
+def write_document(document):
+    """
+    Saves a prepared document's chunks and metadata to tmp/chunks/
+    """
+    id = document["id"]
+    for i, chunk in enumerate(document["chunks"]):
         chunk_path = os.path.join(WORKING_DIR, OUTPUT_DIR, f"{id}-{i}.txt")
         try:
             with open(chunk_path, 'w') as out_file:
@@ -101,7 +193,38 @@ def process_file_pairs(id):
             print("[INFO] Are you sure tmp/chunks/ exists?")
 
     new_json_path = os.path.join(WORKING_DIR, OUTPUT_DIR, f"{id}.json")
-    shutil.copyfile(json_path, new_json_path)
+    with open(new_json_path, 'w') as new_json_file:
+        json.dump(document["metadata"], new_json_file, indent=4)
+
+def process_file_pairs(id, known_hash=None) -> dict:
+    """
+    Processes file pairs of .json and .md raw data and saves the chunks
+    """
+    document = prepare_document(id, known_hash)
+    if document["skipped"]:
+        return document
+    started = time.perf_counter()
+    write_document(document)
+    document["timings"]["write"] = time.perf_counter() - started
+    # The caller only needs the hashes and timings
+    del document["chunks"], document["metadata"]
+    return document
+
+def remove_chunk_files(chunk_ids):
+    for chunk_id in chunk_ids:
+        chunk_path = os.path.join(WORKING_DIR, OUTPUT_DIR, f"{chunk_id}.txt")
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+def report_throughput(totals, documents, elapsed):
+    """
+    Prints documents and chunks per second overall and per stage
+    """
+    print(f"[INFO] Prepared {documents} documents and {int(totals['chunks'])} chunks in {elapsed:.1f}s " +
+        f"({documents / max(elapsed, 1e-9):.1f} docs/s, {totals['chunks'] / max(elapsed, 1e-9):.1f} chunks/s)")
+    for stage in STAGES:
+        # Stage times are summed across workers, so this is per-worker throughput
+        print(f"[INFO]   {stage:<8} {totals[stage]:8.2f}s  {documents / max(totals[stage], 1e-9):10.1f} docs/s")
 
 def get_file_ids() -> set:
     """
@@ -117,13 +240,58 @@ def get_file_ids() -> set:
     return ids
 
 def main() -> int:
+    parser = argparse.ArgumentParser(description="Chunks the raw documents in tmp/raw/")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="number of processes preparing documents")
+    parser.add_argument("--full", action="store_true",
+        help="reprocess every document, even when its content is unchanged")
+    args = parser.parse_args()
+
     print("[INFO] Welcome to the data preparation section of the pipeline!")
     print("[INFO] Please ensure that you have data in tmp/raw/ and that tmp/chunks/ exists")
-    ids = get_file_ids()
+    ids = sorted(get_file_ids())
     print(f"[INFO] Found {len(ids)} '.md' and '.json' file pairs")
-    for id in ids:
-        process_file_pairs(id)
-        print(f"{bcolors.OKGREEN}[INFO] Successfully processed file pair ID #{id}{bcolors.ENDC}")
+
+    manifest = Manifest(WORKING_DIR)
+    known_hashes = manifest.document_hashes()
+
+    # Chunks of documents that are gone from tmp/raw/
+    removed_ids = [id for id in known_hashes if id not in set(ids)]
+    removed = manifest.remove_documents(removed_ids)
+    for id in removed_ids:
+        json_path = os.path.join(WORKING_DIR, OUTPUT_DIR, f"{id}.json")
+        if os.path.exists(json_path):
+            os.remove(json_path)
+
+    totals = dict.fromkeys(STAGES + ["chunks"], 0.0)
+    processed = 0
+    skipped = 0
+    failed = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        hashes = [None if args.full else known_hashes.get(id) for id in ids]
+        for id, result in zip(ids, executor.map(process_file_pairs, ids, hashes, chunksize=16)):
+            if result.get("failed"):
+                failed += 1
+                continue
+            if result["skipped"]:
+                skipped += 1
+                continue
+            for key, value in result["timings"].items():
+                totals[key] += value
+            removed += manifest.record_document(id, result["hash"], result["chunk_hashes"])
+            processed += 1
+            # Commit as we go so an interrupted run resumes where it stopped
+            if processed % 100 == 0:
+                manifest.commit()
+            print(f"{bcolors.OKGREEN}[INFO] Successfully processed file pair ID #{id}{bcolors.ENDC}")
+    manifest.close()
+
+    remove_chunk_files(removed)
+    print(f"[INFO] Skipped {skipped} unchanged documents and removed {len(removed)} chunks")
+    if failed > 0:
+        print(f"{bcolors.FAIL}[ERROR] {failed} documents could not be prepared{bcolors.ENDC}")
+    report_throughput(totals, processed, time.perf_counter() - started)
     print("[INFO] Process finished")
     return 0
 
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import prepare_data
+import generate_embeddings
+import store_embeddings
+import build_chunk_store
+import build_lexical_index
+import build_local_index
+from manifest import Manifest
+from uploader import Uploader, FakeIndex
+
+WORKING_DIR = os.path.join(".","..","tmp")
+
+class bcolors:
+    HEADER = '\033[95m'
+    OKBLUE = '\033[94m'
+    OKCYAN = '\033[96m'
+    OKGREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    ENDC = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+
+# Marks the end of a stage's output
+DONE = object()
+
+class StageError(Exception):
+    """Custom exception to indicate another pipeline stage failed."""
+
+class Stage(threading.Thread):
+    """
+    Runs one pipeline stage in a thread and keeps its exception for the
+    runner. A failing stage sets the shared abort event so stages blocked on
+    a full or empty queue give up instead of waiting forever.
+    """
+
+    def __init__(self, name, target, abort: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.target_fn = target
+        self.abort = abort
+        self.error = None
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self.target_fn()
+        except BaseException as err:
+            self.error = err
+            self.abort.set()
+
+def put(q: queue.Queue, item, abort: threading.Event):
+    while True:
+        if abort.is_set():
+            raise StageError("Pipeline aborted")
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+def drain(q: queue.Queue, abort: threading.Event):
+    """
+    Yields items from a queue until the upstream stage is done
+    """
+    while True:
+        if abort.is_set():
+            raise StageError("Pipeline aborted")
+        try:
+            item = q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if item is DONE:
+            return
+        yield item
+
+def bounded_map(executor, fn, items, window):
+    """
+    Like executor.map, but only keeps window tasks submitted at a time so
+    results do not pile up ahead of the consumer
+    """
+    pending = deque()
+    for args in items:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def prepare_stage(ids, known_hashes, removed_ids, args, chunks_queue, abort, counters) -> list[str]:
+    """
+    Chunks changed documents across a process pool and passes each new or
+    changed chunk on as (chunk_id, text, document metadata). Unless --full,
+    chunks of a changed document that are already embedded and uploaded at
+    their current hash are left out. Returns the removed chunk ids.
+    """
+    manifest = Manifest(WORKING_DIR)
+    removed = manifest.remove_documents(removed_ids)
+    manifest.commit()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        items = [(id, known_hashes.get(id)) for id in ids]
+        for document in bounded_map(executor, prepare_data.prepare_document, items, args.workers * 4):
+            if document.get("failed"):
+                counters["failed"] += 1
+                continue
+            if document["skipped"]:
+                counters["skipped"] += 1
+                continue
+            if args.debug_output:
+                prepare_data.write_document(document)
+            removed += manifest.record_document(document["id"], document["hash"], document["chunk_hashes"])
+            manifest.commit()
+            counters["documents"] += 1
+
+            pending = None if args.full else manifest.pending_chunks(document["id"], fake=args.fake_index)
+            metadata_content = json.dumps(document["metadata"])
+            for i, chunk in enumerate(document["chunks"]):
+                chunk_id = f"{document['id']}-{i}"
+                if pending is not None and chunk_id not in pending:
+                    counters["unchanged_chunks"] += 1
+                    continue
+                put(chunks_queue, (chunk_id, chunk, metadata_content), abort)
+    manifest.close()
+    put(chunks_queue, DONE, abort)
+    return removed
+
+def embed_stage(args, chunks_queue, vectors_queue, abort, counters, store_writer):
+    """
+    Encodes chunks in batches and passes each on as a vector record. The
+    chunk store row of each encoded chunk is staged in store_writer as its
+    batch completes.
+    """
+    manifest = Manifest(WORKING_DIR)
+    model = generate_embeddings.get_model()
+
+    def flush(batch):
+        if len(batch) == 0:
+            return
+        embeddings = model.encode([text for _, text, _ in batch], batch_size=args.batch_size)
+        # Record the embedded hashes first so the store stage marks the
+        # right content as stored
+        manifest.mark_embedded([chunk_id for chunk_id, _, _ in batch])
+        rows = []
+        for (chunk_id, text, metadata_content), values in zip(batch, embeddings):
+            metadata = generate_embeddings.chunk_metadata(chunk_id, text, metadata_content)
+            rows.append(build_chunk_store.to_row(chunk_id, metadata, values))
+            if args.debug_output:
+                write_embedding(values, metadata)
+            put(vectors_queue, store_embeddings.to_vector(values.tolist(), metadata), abort)
+        store_writer.add(rows)
+        counters["chunks"] += len(batch)
+
+    batch = []
+    for item in drain(chunks_queue, abort):
+        batch.append(item)
+        if len(batch) >= args.batch_size:
+            flush(batch)
+            batch = []
+    flush(batch)
+    manifest.close()
+    put(vectors_queue, DONE, abort)
+
+def store_stage(index, args, vectors_queue, abort) -> Uploader:
+    manifest = Manifest(WORKING_DIR)
+    uploader = Uploader(index, store_embeddings.INDEX_NAME,
+        max_in_flight=args.max_in_flight,
+        max_batch_count=store_embeddings.MAX_BATCH_SIZE,
+        # Nothing reaches Pinecone with the fake index, so its uploads are
+        # recorded apart and the next real run still uploads everything
+        on_success=manifest.mark_fake_stored if args.fake_index else manifest.mark_stored)
+    uploader.upload(drain(vectors_queue, abort))
+    manifest.close()
+    return uploader
+
+def update_chunk_store(store_writer, removed, replace):
+    """
+    Applies the chunks encoded in this run and the removed ones to the
+    backend's chunk store, then rebuilds the keyword index and any local
+    vector index from it. The backend reads chunk text from the store, so it
+    must change together with the vectors.
+
+    The staged rows only replace the store when replace is set, which the
+    caller limits to --full runs where every stage and document succeeded.
+    Otherwise they are merged in, so a failed run never drops chunks whose
+    vectors are still in the index.
+    """
+    store_path = os.path.join(WORKING_DIR, build_chunk_store.OUTPUT_FILE)
+    existed = os.path.exists(store_path)
+    if replace:
+        count = store_writer.replace_store()
+        print(f"[INFO] Rebuilt {store_path} with {count} chunks")
+    elif existed and store_writer.count == 0 and len(removed) == 0:
+        store_writer.discard()
+        print("[INFO] Chunk store is up to date")
+        return
+    else:
+        count = store_writer.merge_into_store(removed)
+        print(f"[INFO] Updated {store_writer.count} and removed {len(removed)} chunks in {store_path} ({count} chunks)")
+    if not existed and not replace:
+        print(f"{bcolors.WARNING}[WARN] The chunk store did not exist, so it only holds the chunks " +
+            f"encoded in this run. Run with --full once to fill it{bcolors.ENDC}")
+
+    texts, chunks, vectors = build_lexical_index.read_chunk_store()
+    if len(chunks) > 0:
+        output_path = build_lexical_index.write_index(texts, chunks, vectors)
+        print(f"[INFO] Rebuilt the lexical index in {output_path}")
+    # Only kept up to date once built, since Pinecone deployments have none
+    output_path = build_local_index.update_from_store()
+    if output_path is not None:
+        print(f"[INFO] Rebuilt the local vector index in {output_path}")
+
+def write_embedding(values, metadata):
+    """
+    Saves a chunk's embeddings in the generate_embeddings.py json format
+    """
+    output_path = os.path.join(WORKING_DIR, generate_embeddings.OUTPUT_DIR, f"{metadata['chunk_id']}.json")
+    with open(output_path, "w") as output_file:
+        json.dump({"embeddings": values.tolist(), "metadata": metadata}, output_file, indent=4)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Runs prepare, embed and store as one streaming pipeline")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="number of processes preparing documents")
+    parser.add_argument("--batch-size", type=int, default=256,
+        help="number of chunks per encode call")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default=generate_embeddings.EMBEDDING_BACKEND,
+        help="embedding model runtime, defaults to EMBEDDING_BACKEND or torch")
+    parser.add_argument("--buffer-size", type=int, default=1024,
+        help="maximum number of items waiting between two stages")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+        help="number of upsert requests sent concurrently")
+    parser.add_argument("--full", action="store_true",
+        help="process every document, even when its content is unchanged")
+    parser.add_argument("--debug-output", action="store_true",
+        help="also write tmp/chunks/ and tmp/embeddings/ files like the individual stages")
+    parser.add_argument("--fake-index", action="store_true",
+        help="upload to an in-memory index instead of Pinecone, recording uploads apart from real ones in the manifest")
+    args = parser.parse_args()
+    generate_embeddings.EMBEDDING_BACKEND = args.backend
+
+    print("[INFO] Welcome to the streaming pipeline runner!")
+    print("[INFO] Please ensure that you have data in tmp/raw/")
+    index = FakeIndex() if args.fake_index else store_embeddings.connect_index()
+    store_embeddings.pc_index = index
+
+    ids = sorted(prepare_data.get_file_ids())
+    manifest = Manifest(WORKING_DIR)
+    document_hashes = manifest.document_hashes()
+    removed_ids = [id for id in document_hashes if id not in set(ids)]
+    known_hashes = {} if args.full else document_hashes
+    # Documents with chunks a previous run did not finish are processed again.
+    # Vectors only live in memory between the stages, so chunks embedded but
+    # never uploaded are encoded again too. Fake index runs count earlier
+    # fake uploads as done, while a real run after them uploads everything.
+    for chunk_id in manifest.pending_embeddings() | manifest.pending_uploads(fake=args.fake_index):
+        known_hashes.pop(chunk_id.rsplit("-", 1)[0], None)
+    manifest.close()
+    print(f"[INFO] Found {len(ids)} '.md' and '.json' file pairs")
+
+    chunks_queue = queue.Queue(maxsize=args.buffer_size)
+    vectors_queue = queue.Queue(maxsize=args.buffer_size)
+    abort = threading.Event()
+    counters = {"documents": 0, "skipped": 0, "failed": 0, "chunks": 0, "unchanged_chunks": 0}
+    store_writer = build_chunk_store.StoreWriter()
+
+    started = time.perf_counter()
+    stages = [
+        Stage("prepare", lambda: prepare_stage(ids, known_hashes, removed_ids, args, chunks_queue, abort, counters), abort),
+        Stage("embed", lambda: embed_stage(args, chunks_queue, vectors_queue, abort, counters, store_writer), abort),
+        Stage("store", lambda: store_stage(index, args, vectors_queue, abort), abort),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    # Chunks encoded before a failure may already be stored, and the next
+    # run will not encode them again, so the store is updated either way
+    failed = [stage for stage in stages if stage.error is not None and not isinstance(stage.error, StageError)]
+    complete = len(failed) == 0 and counters["failed"] == 0
+    update_chunk_store(store_writer, stages[0].result or [], args.full and complete)
+
+    for stage in failed:
+        print(f"{bcolors.FAIL}[ERROR] The {stage.name} stage failed: {stage.error}{bcolors.ENDC}")
+    if failed:
+        return 1
+
+    removed, uploader = stages[0].result, stages[2].result
+    if args.debug_output:
+        prepare_data.remove_chunk_files(removed)
+    store_embeddings.write_failed_ids(uploader.failed_ids)
+    manifest = Manifest(WORKING_DIR)
+    deleted = store_embeddings.delete_removed_vectors(manifest, record=not args.fake_index)
+    manifest.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"[INFO] Prepared {counters['documents']} documents ({counters['skipped']} unchanged), " +
+        f"encoded {counters['chunks']} chunks ({counters['unchanged_chunks']} unchanged) and uploaded {uploader.uploaded} vectors in {elapsed:.1f}s " +
+        f"({counters['chunks'] / max(elapsed, 1e-9):.1f} chunks/s)")
+    print(f"[INFO] Deleted {deleted} vectors of removed chunks")
+    if counters["failed"] > 0:
+        print(f"{bcolors.FAIL}[ERROR] {counters['failed']} documents could not be prepared{bcolors.ENDC}")
+    if len(uploader.failed_ids) > 0:
+        print(f"{bcolors.FAIL}[ERROR] {len(uploader.failed_ids)} embeddings failed. Rerun store_embeddings.py with --replay to retry them{bcolors.ENDC}")
+    print("[INFO] Process finished")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,23 @@
 import os
 import sys
 import json
+import argparse
+import numpy as np
 
 from dotenv import load_dotenv
 from pinecone.grpc import PineconeGRPC as Pinecone
 from pinecone import ServerlessSpec
+from manifest import Manifest
+from uploader import Uploader, FakeIndex
 
 WORKING_DIR = os.path.join(".","..","tmp")
 INPUT_DIR = "embeddings"
 DIMENSIONS = 384
 MAX_BATCH_SIZE = 100
+MAX_DELETE_BATCH_SIZE = 1000
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.jsonl"
+FAILED_IDS_FILE = "failed_ids.txt"
 
 class bcolors:
     HEADER = '\033[95m'
@@ -24,27 +32,33 @@ class bcolors:
 
 load_dotenv()
 
-INDEX_NAME = os.environ['VECTOR_DB_INDEX_NAME']
-pc = Pinecone(api_key=os.environ['VECTOR_DB_API_KEY'])
-
-if not pc.has_index(INDEX_NAME):
-    pc.create_index(
-        name=INDEX_NAME,
-        vector_type="dense",
-        dimension=DIMENSIONS,
-        metric="cosine",
-        spec=ServerlessSpec(
-            cloud="aws",
-            region="us-east-1"
-        ),
-        deletion_protection="disabled",
-        tags={
-            "environment": "development"
-        }
-    )
-
-INDEX_HOST = pc.describe_index(name=INDEX_NAME)["host"] 
-pc_index = pc.Index(host=INDEX_HOST)
+INDEX_NAME = os.getenv('VECTOR_DB_INDEX_NAME')
+pc_index = None
+
+def connect_index():
+    """
+    Connects to the Pinecone index, creating it if it does not exist yet
+    """
+    pc = Pinecone(api_key=os.environ['VECTOR_DB_API_KEY'])
+
+    if not pc.has_index(INDEX_NAME):
+        pc.create_index(
+            name=INDEX_NAME,
+            vector_type="dense",
+            dimension=DIMENSIONS,
+            metric="cosine",
+            spec=ServerlessSpec(
+                cloud="aws",
+                region="us-east-1"
+            ),
+            deletion_protection="disabled",
+            tags={
+                "environment": "development"
+            }
+        )
+
+    INDEX_HOST = pc.describe_index(name=INDEX_NAME)["host"] 
+    return pc.Index(host=INDEX_HOST)
 
 def get_vectors_from_file(embedding_id):
     """
@@ -64,6 +78,12 @@ def get_vectors_from_file(embedding_id):
     metadata = data["metadata"]
 
     assert(metadata["id"] == base_id)
+    return to_vector(embeddings, metadata)
+
+def to_vector(embeddings, metadata) -> dict:
+    """
+    Converts a chunk's embeddings and metadata to a vector database record
+    """
     assert(len(embeddings) == DIMENSIONS)
 
     vectors = {}
@@ -74,15 +94,57 @@ def get_vectors_from_file(embedding_id):
     vectors["metadata"] = metadata
     return vectors
 
-def upload_vectors(vectors) -> int:
-    try:
-        # In the future, may use multiple namespaces
-        pc_index.upsert(vectors=vectors, namespace=INDEX_NAME)
-        print(f"{bcolors.OKGREEN}[INFO] Succesfully uploaded vector batch{bcolors.ENDC}")
-        return len(vectors)
-    except:
-        print(f"{bcolors.FAIL}[ERROR] Upload of vector batch failed{bcolors.ENDC}")
-        return 0
+def read_binary_vectors():
+    """
+    Yields vectors from the vectors.npy matrix and metadata.jsonl table
+    written by generate_embeddings.py
+    """
+    matrix = np.load(os.path.join(WORKING_DIR, INPUT_DIR, VECTORS_FILE), mmap_mode="r")
+    with open(os.path.join(WORKING_DIR, INPUT_DIR, METADATA_FILE), "r") as metadata_file:
+        for row, line in enumerate(metadata_file):
+            yield to_vector(matrix[row].tolist(), json.loads(line))
+
+def has_binary_vectors() -> bool:
+    return os.path.exists(os.path.join(WORKING_DIR, INPUT_DIR, METADATA_FILE))
+
+def read_failed_ids() -> set:
+    path = os.path.join(WORKING_DIR, FAILED_IDS_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as failed_file:
+        return {line.strip() for line in failed_file if line.strip()}
+
+def write_failed_ids(ids):
+    """
+    Records ids whose upload failed so they can be replayed with --replay
+    """
+    path = os.path.join(WORKING_DIR, FAILED_IDS_FILE)
+    if len(ids) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w") as failed_file:
+        for id in sorted(ids):
+            failed_file.write(f"{id}\n")
+
+def delete_removed_vectors(manifest, record: bool = True) -> int:
+    """
+    Deletes vectors for chunks that no longer exist in the prepared data.
+    With record off the manifest is left as is, for test indexes.
+    """
+    ids = manifest.pending_deletes()
+    deleted = 0
+    for start in range(0, len(ids), MAX_DELETE_BATCH_SIZE):
+        batch = ids[start:start + MAX_DELETE_BATCH_SIZE]
+        try:
+            pc_index.delete(ids=batch, namespace=INDEX_NAME)
+        except:
+            print(f"{bcolors.FAIL}[ERROR] Deletion of vector batch failed{bcolors.ENDC}")
+            continue
+        if record:
+            manifest.mark_deleted_from_store(batch)
+        deleted += len(batch)
+    return deleted
 
 def get_file_ids() -> set:
     """
@@ -98,27 +160,62 @@ def get_file_ids() -> set:
     return ids
 
 def main() -> int:
+    global pc_index
+    parser = argparse.ArgumentParser(description="Uploads the embeddings in tmp/embeddings/")
+    parser.add_argument("--full", action="store_true",
+        help="upload every embedding instead of only ones not stored yet")
+    parser.add_argument("--replay", action="store_true",
+        help=f"only upload the ids listed in tmp/{FAILED_IDS_FILE} by a previous run")
+    parser.add_argument("--max-in-flight", type=int, default=4,
+        help="number of upsert requests sent concurrently")
+    parser.add_argument("--max-retries", type=int, default=5,
+        help="retries per batch before its ids are recorded as failed")
+    parser.add_argument("--fake-index", action="store_true",
+        help="upload to an in-memory index instead of Pinecone, recording uploads apart from real ones in the manifest")
+    args = parser.parse_args()
+
     print("[INFO] Welcome to the embedding storage section of the pipeline!")
     print("[INFO] Please ensure that you have data in tmp/embeddings/")
-    ids = get_file_ids()
-    print(f"[INFO] Found {len(ids)} embeddings")
-    print(f"[INFO] Now uploading embeddings in batch sizes of {MAX_BATCH_SIZE}\n")
-
-    batch = []
-    uploaded = 0
-
-    for id in ids:
-        vec = get_vectors_from_file(id)
-        if len(batch) >= MAX_BATCH_SIZE:
-            uploaded += upload_vectors(batch)
-            print(f"{uploaded}/{len(ids)} processed...\r")
-            batch = []
-        batch.append(vec)
-        
-    # Upload remaining vecs in batch
-    if len(batch) > 0:
-        uploaded += upload_vectors(batch)
-        print(f"{uploaded}/{len(ids)} processed...\r")
+    pc_index = FakeIndex() if args.fake_index else connect_index()
+    manifest = Manifest(WORKING_DIR)
+    pending = None
+    if args.replay:
+        pending = read_failed_ids()
+    elif not args.full and manifest.has_chunks():
+        pending = manifest.pending_uploads(fake=args.fake_index)
+
+    if has_binary_vectors():
+        total = len(np.load(os.path.join(WORKING_DIR, INPUT_DIR, VECTORS_FILE), mmap_mode="r"))
+        vectors = read_binary_vectors()
+        if pending is not None:
+            total = len(pending)
+            vectors = (vec for vec in vectors if vec["id"] in pending)
+    else:
+        ids = get_file_ids()
+        if pending is not None:
+            ids = ids & pending
+        total = len(ids)
+        vectors = (get_vectors_from_file(id) for id in ids)
+    print(f"[INFO] Found {total} embeddings")
+    print(f"[INFO] Now uploading embeddings with up to {args.max_in_flight} batches of {MAX_BATCH_SIZE} in flight\n")
+
+    # In the future, may use multiple namespaces
+    uploader = Uploader(pc_index, INDEX_NAME,
+        max_in_flight=args.max_in_flight,
+        max_batch_count=MAX_BATCH_SIZE,
+        max_retries=args.max_retries,
+        # Nothing reaches Pinecone with the fake index, so its uploads are
+        # recorded apart and the next real run still uploads everything
+        on_success=manifest.mark_fake_stored if args.fake_index else manifest.mark_stored)
+    uploaded = uploader.upload(vectors)
+    write_failed_ids(uploader.failed_ids)
+    print(f"{bcolors.OKGREEN}[INFO] Uploaded {uploaded}/{total} embeddings with {uploader.retries} retries{bcolors.ENDC}")
+    if len(uploader.failed_ids) > 0:
+        print(f"{bcolors.FAIL}[ERROR] {len(uploader.failed_ids)} embeddings failed. Rerun with --replay to retry them{bcolors.ENDC}")
+
+    deleted = delete_removed_vectors(manifest, record=not args.fake_index)
+    print(f"[INFO] Deleted {deleted} vectors of removed chunks")
+    manifest.close()
 
     print("[INFO] Process finished")
     return 0
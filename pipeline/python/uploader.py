@@ -0,0 +1,137 @@
+import json
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Iterator
+
+# Pinecone rejects upsert requests over 2MB or 1000 vectors
+MAX_BATCH_COUNT = 100
+MAX_BATCH_BYTES = 2 * 1024 * 1024 - 64 * 1024
+
+def estimate_bytes(vector: dict) -> int:
+    """
+    Rough wire size of a vector record: 4 bytes per value plus id and metadata
+    """
+    return len(vector["id"]) + 4 * len(vector["values"]) + len(json.dumps(vector.get("metadata", {})))
+
+def make_batches(vectors: Iterable[dict], max_count: int, max_bytes: int) -> Iterator[list[dict]]:
+    """
+    Groups a stream of vectors into batches limited by count and by size
+    """
+    batch = []
+    size = 0
+    for vector in vectors:
+        vector_size = estimate_bytes(vector)
+        if batch and (len(batch) >= max_count or size + vector_size > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(vector)
+        size += vector_size
+    if batch:
+        yield batch
+
+class FakeIndex:
+    """
+    In-memory stand-in for a Pinecone index. Fails a share of requests when
+    failure_rate is set so retries can be exercised locally.
+    """
+
+    def __init__(self, failure_rate: float = 0.0, latency: float = 0.0):
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.vectors: dict[str, dict] = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors, namespace=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if random.random() < self.failure_rate:
+                raise ConnectionError("Simulated upsert failure")
+            for vector in vectors:
+                self.vectors[vector["id"]] = vector
+
+    def delete(self, ids, namespace=None):
+        with self.lock:
+            for id in ids:
+                self.vectors.pop(id, None)
+
+class Uploader:
+    """
+    Upserts a stream of vectors with a bounded number of batches in flight.
+    Failed batches are retried with exponential backoff and their ids are
+    collected for replay once the retries run out.
+
+    on_success is called with the ids of each stored batch from the calling
+    thread, so it may use objects that are not thread-safe (like a SQLite
+    connection).
+    """
+
+    def __init__(
+        self,
+        index,
+        namespace: str,
+        max_in_flight: int = 4,
+        max_batch_count: int = MAX_BATCH_COUNT,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        on_success: Callable[[list[str]], None] | None = None,
+    ):
+        self.index = index
+        self.namespace = namespace
+        self.max_in_flight = max_in_flight
+        self.max_batch_count = max_batch_count
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.on_success = on_success
+        self.uploaded = 0
+        self.retries = 0
+        self.failed_ids: list[str] = []
+
+    def upload(self, vectors: Iterable[dict]) -> int:
+        """
+        Uploads every vector and returns how many were stored
+        """
+        batches = make_batches(vectors, self.max_batch_count, self.max_batch_bytes)
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for batch in batches:
+                # Only pull more input once a slot frees up
+                if len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._collect(done)
+                in_flight.add(executor.submit(self._send, batch))
+            done, _ = wait(in_flight)
+            self._collect(done)
+        return self.uploaded
+
+    def _send(self, batch: list[dict]) -> tuple[list[str], Exception | None]:
+        ids = [vector["id"] for vector in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.index.upsert(vectors=batch, namespace=self.namespace)
+                return ids, None
+            except Exception as err:
+                if attempt == self.max_retries:
+                    return ids, err
+                self.retries += 1
+                delay = self.base_delay * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+
+    def _collect(self, done):
+        for future in done:
+            ids, err = future.result()
+            if err is not None:
+                print(f"[ERROR] Upload of {len(ids)} vectors failed after {self.max_retries} retries: {err}")
+                self.failed_ids += ids
+                continue
+            self.uploaded += len(ids)
+            if self.on_success is not None:
+                self.on_success(ids)
+            print(f"{self.uploaded} uploaded...\r")